@@ -0,0 +1,69 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request coalescing used by GCE daemon."""
+
+import logging
+import threading
+from time import time
+
+
+class Batcher(threading.Thread):
+  """Coalesces items from many threads into batched calls.
+
+  A batch is sent with send_batch once max_size items are waiting, or
+  window_sec after the first item of the batch arrived. send_batch takes a
+  list of items and returns a list with one result per item.
+  """
+
+  def __init__(self, name, send_batch, max_size, window_sec):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self.send_batch = send_batch
+    self.max_size = max_size
+    self.window_sec = window_sec
+    self.item_available = threading.Condition()
+    # Waiting items, as [item, done event, result] entries.
+    self.pending = []
+
+  def Send(self, item):
+    """Queues an item and returns its result once its batch was sent."""
+    entry = [item, threading.Event(), None]
+    with self.item_available:
+      self.pending.append(entry)
+      self.item_available.notify()
+    entry[1].wait()
+    return entry[2]
+
+  def run(self):
+    while True:
+      with self.item_available:
+        while not self.pending:
+          self.item_available.wait()
+        send_time = time() + self.window_sec
+        while len(self.pending) < self.max_size and time() < send_time:
+          self.item_available.wait(send_time - time())
+        batch = self.pending[:self.max_size]
+        del self.pending[:self.max_size]
+
+      try:
+        results = self.send_batch([item for item, _, _ in batch])
+      except Exception, e:
+        logging.error('Error sending %s batch: %s', self.name, e)
+        results = [None] * len(batch)
+      logging.info('Sent %s batch of %d.', self.name, len(batch))
+
+      for entry, result in zip(batch, results):
+        entry[2] = result
+        entry[1].set()
@@ -0,0 +1,317 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline throughput benchmark for the bitify pipeline in image_processing.
+
+Runs ConvertToBitifiedImage over a generated corpus of JPEG, PNG and GIF
+images at several resolutions, and times each helper on its own. Reports
+images/sec, seconds per pipeline stage and helper, the memory each helper
+call needs (on Linux 4.0 and later) and peak RSS.
+
+Timings depend on the machine, so save a baseline on the machine that runs
+the comparison, e.g. before a PIL upgrade or settings.py change:
+
+  python benchmark.py --save-baseline baseline.json
+  (upgrade PIL or change settings.py)
+  python benchmark.py --baseline baseline.json
+
+The comparison exits with status 1 if any timing got slower, throughput
+lower or peak RSS higher by more than --threshold. Timings that changed by
+less than --min-seconds, and helper memory by less than 256 KB, are not
+counted, as they are mostly noise.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+import Image
+import ImageDraw
+
+import image_processing
+from profiling import Percentile
+from profiling import StageClock
+import settings
+
+# Settings recorded with the results, as they change what is measured.
+BENCHMARK_SETTINGS = ('BIT_DEPTH', 'THUMBNAIL_WIDTH', 'FINAL_WIDTH',
+                      'FAST_PATH', 'FAST_PATH_WORKING_WIDTH', 'FONT_SIZE',
+                      'BORDER_EDGE_SIZE_PIXELS')
+DEFAULT_SIZES = '640x480,1600x1200,4000x3000'
+FORMATS = ('JPEG', 'PNG', 'GIF')
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}
+# Image and text the helpers are timed on.
+HELPER_IMAGE_SIZE = (768, 576)
+HELPER_TEXT = ('The quick brown fox jumps over the lazy dog, then naps in '
+               'the sun for the rest of the afternoon.')
+# Smallest change in a helper's memory counted as a regression.
+MIN_MEMORY_CHANGE_KB = 256
+
+
+def GenerateImage(size, seed):
+  """Returns a photo-like RGB test image: a gradient with random shapes."""
+  rand = random.Random(seed)
+  corners = Image.new('RGB', (2, 2))
+  corners.putdata([tuple(rand.randint(0, 255) for _ in xrange(3))
+                   for _ in xrange(4)])
+  image = corners.resize(size, Image.BILINEAR)
+  draw = ImageDraw.Draw(image)
+  width, height = size
+  for _ in xrange(40):
+    x, y = rand.randint(0, width), rand.randint(0, height)
+    radius = rand.randint(width / 40, width / 6)
+    color = tuple(rand.randint(0, 255) for _ in xrange(3))
+    shape = rand.choice((draw.ellipse, draw.rectangle))
+    shape([x - radius, y - radius, x + radius, y + radius], fill=color)
+  return image
+
+
+def GenerateCorpus(directory, sizes):
+  """Writes a test image per size and format, returns their paths."""
+  paths = []
+  for index, size in enumerate(sizes):
+    image = GenerateImage(size, index)
+    for image_format in FORMATS:
+      path = os.path.join(directory, '%dx%d.%s' % (size[0], size[1],
+                                                   EXTENSIONS[image_format]))
+      if image_format == 'GIF':
+        image.convert('P', palette=Image.ADAPTIVE).save(path, image_format)
+      else:
+        image.save(path, image_format)
+      paths.append(path)
+  return paths
+
+
+def Median(values):
+  return Percentile(values, 50)
+
+
+def BenchmarkPipeline(paths, iterations):
+  """Times ConvertToBitifiedImage over the corpus.
+
+  Returns images/sec, and the median seconds per image and per stage (summed
+  over the corpus) across iterations.
+  """
+  image_times = dict((os.path.basename(path), []) for path in paths)
+  stage_times = {}
+  total_time = 0
+  for _ in xrange(iterations):
+    # Same quotes on every run.
+    random.seed(0)
+    pass_stages = {}
+    for path in paths:
+      clock = StageClock()
+      time_start = time()
+      image_processing.ConvertToBitifiedImage(path, clock=clock)
+      image_time = time() - time_start
+      total_time += image_time
+      image_times[os.path.basename(path)].append(image_time)
+      for stage, seconds in clock.timings.iteritems():
+        pass_stages[stage] = pass_stages.get(stage, 0) + seconds
+    for stage, seconds in pass_stages.iteritems():
+      stage_times.setdefault(stage, []).append(seconds)
+
+  return {
+      'imagesPerSec': len(paths) * iterations / total_time,
+      'images': dict((name, Median(times))
+                     for name, times in image_times.iteritems()),
+      'stages': dict((stage, Median(times))
+                     for stage, times in stage_times.iteritems())
+  }
+
+
+def Helpers(width, height):
+  """Returns the image_processing helpers to time, each taking an image."""
+  return {
+      'AddBorderToImage': image_processing.AddBorderToImage,
+      'AddTextToImage': lambda copy: image_processing.AddTextToImage(
+          copy, HELPER_TEXT),
+      'RenderTextMask': lambda copy: image_processing.RenderTextMask(
+          HELPER_TEXT, width),
+      'DrawBlurredRectangle': lambda copy: (
+          image_processing.DrawBlurredRectangle(
+              copy, [0, height - 10, width, height - 70])),
+      'GetImageWrappedText': lambda copy: (
+          image_processing.GetImageWrappedText(
+              width, ImageDraw.Draw(copy), HELPER_TEXT,
+              image_processing.FONT))
+  }
+
+
+def BenchmarkHelpers(iterations):
+  """Returns the median seconds per call of each image_processing helper.
+
+  AddTextToImage reuses the quote's cached mask after its first call, and
+  RenderTextMask is the cost of rendering one, as paid on a cache miss.
+  """
+  image = GenerateImage(HELPER_IMAGE_SIZE, 0)
+  results = {}
+  for name, helper in Helpers(*image.size).iteritems():
+    times = []
+    for _ in xrange(iterations):
+      # Helpers draw onto their image, so each call gets a fresh copy.
+      copy = image.copy()
+      time_start = time()
+      helper(copy)
+      times.append(time() - time_start)
+    results[name] = Median(times)
+  return results
+
+
+def PeakRssKb():
+  """Returns the peak RSS since the last ResetPeakRss(), in KB."""
+  with open('/proc/self/status') as status:
+    for line in status:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1])
+
+
+def ResetPeakRss():
+  """Resets the peak RSS to the current RSS (Linux 4.0 and later)."""
+  with open('/proc/self/clear_refs', 'w') as clear_refs:
+    clear_refs.write('5')
+
+
+def MeasureHelperMemory(name):
+  """Returns how far one call of a helper raises peak RSS, in KB."""
+  image = GenerateImage(HELPER_IMAGE_SIZE, 0)
+  helper = Helpers(*image.size)[name]
+  ResetPeakRss()
+  peak_before = PeakRssKb()
+  helper(image)
+  return PeakRssKb() - peak_before
+
+
+def BenchmarkHelperMemory():
+  """Returns the KB of memory each helper call needs, or None if unknown.
+
+  Each helper is measured in a fresh process, where it cannot reuse memory
+  freed by earlier calls.
+  """
+  results = {}
+  for name in Helpers(*HELPER_IMAGE_SIZE):
+    try:
+      results[name] = int(subprocess.check_output(
+          [sys.executable, os.path.abspath(__file__),
+           '--measure-helper-memory', name]))
+    except (subprocess.CalledProcessError, ValueError):
+      return None
+  return results
+
+
+def Compare(results, baseline, threshold, min_seconds):
+  """Prints results against baseline, returns the regressed metric names."""
+  for name in BENCHMARK_SETTINGS:
+    if baseline['settings'].get(name) != results['settings'][name]:
+      print 'Note: %s was %r in the baseline, now %r.' % (
+          name, baseline['settings'].get(name), results['settings'][name])
+
+  # (name, baseline value, current value, smallest change counted)
+  metrics = [('imagesPerSec', baseline['pipeline']['imagesPerSec'],
+              results['pipeline']['imagesPerSec'], 0),
+             ('peakRssKb', baseline['peakRssKb'], results['peakRssKb'], 0)]
+  for group in ('images', 'stages'):
+    for name, value in sorted(results['pipeline'][group].iteritems()):
+      if name in baseline['pipeline'][group]:
+        metrics.append(('%s/%s' % (group, name),
+                        baseline['pipeline'][group][name], value,
+                        min_seconds))
+  for name, value in sorted(results['helpers'].iteritems()):
+    if name in baseline['helpers']:
+      metrics.append(('helpers/' + name, baseline['helpers'][name], value,
+                      min_seconds))
+  for name, value in sorted((results['helperMemoryKb'] or {}).iteritems()):
+    if name in (baseline.get('helperMemoryKb') or {}):
+      metrics.append(('helperMemoryKb/' + name,
+                      baseline['helperMemoryKb'][name], value,
+                      MIN_MEMORY_CHANGE_KB))
+
+  regressions = []
+  print '%-32s %12s %12s %8s' % ('metric', 'baseline', 'current', 'change')
+  for name, old, new, min_change in metrics:
+    change = float(new) / old - 1 if old else 0
+    if name == 'imagesPerSec':
+      regressed = change < -threshold
+    else:
+      regressed = change > threshold and new - old >= min_change
+    if regressed:
+      regressions.append(name)
+    print '%-32s %12.4f %12.4f %+7.1f%%%s' % (name, old, new, change * 100,
+                                              ' REGRESSION' if regressed
+                                              else '')
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                      help='Comma separated WIDTHxHEIGHT corpus image sizes.')
+  parser.add_argument('--iterations', type=int, default=3,
+                      help='Passes over the corpus; medians are reported.')
+  parser.add_argument('--helper-iterations', type=int, default=20)
+  parser.add_argument('--baseline', help='JSON results to compare against.')
+  parser.add_argument('--save-baseline', help='Write the results here.')
+  parser.add_argument('--threshold', type=float, default=0.15,
+                      help='Allowed relative regression (default 0.15).')
+  parser.add_argument('--min-seconds', type=float, default=0.005,
+                      help='Smallest timing change counted as a regression.')
+  # Run by BenchmarkHelperMemory() in a fresh process.
+  parser.add_argument('--measure-helper-memory', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.measure_helper_memory:
+    print MeasureHelperMemory(args.measure_helper_memory)
+    return
+
+  sizes = [tuple(int(n) for n in size.split('x'))
+           for size in args.sizes.split(',')]
+  corpus_dir = tempfile.mkdtemp(prefix='smashpix_benchmark_')
+  try:
+    paths = GenerateCorpus(corpus_dir, sizes)
+    results = {
+        'settings': dict((name, getattr(settings, name))
+                         for name in BENCHMARK_SETTINGS),
+        'pipeline': BenchmarkPipeline(paths, args.iterations),
+        'helpers': BenchmarkHelpers(args.helper_iterations),
+        'helperMemoryKb': BenchmarkHelperMemory(),
+        # Kilobytes on Linux.
+        'peakRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+  finally:
+    shutil.rmtree(corpus_dir)
+
+  print json.dumps(results, indent=2, sort_keys=True)
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as baseline_file:
+      json.dump(results, baseline_file, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    regressions = Compare(results, baseline, args.threshold,
+                          args.min_seconds)
+    if regressions:
+      print 'Regressed beyond %g%%: %s' % (args.threshold * 100,
+                                           ', '.join(regressions))
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,69 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Perceptual-difference report between the full and fast-path pipelines.
+
+Usage: python compare_pipelines.py IMAGE [IMAGE ...]
+"""
+import math
+import random
+import sys
+from time import time
+
+import ImageChops
+import ImageStat
+
+from image_processing import ConvertToBitifiedImage
+
+
+def RunPipeline(file_location, fast_path, seed):
+  """Returns the processed image and the seconds taken to produce it."""
+  # Same seed for both pipelines so they overlay the same quote.
+  random.seed(seed)
+  time_start = time()
+  image = ConvertToBitifiedImage(file_location, fast_path=fast_path)
+  return image, time() - time_start
+
+
+def CompareImages(image, other):
+  """Returns mean absolute error and PSNR (dB) between two RGB images."""
+  diff = ImageChops.difference(image, other)
+  stat = ImageStat.Stat(diff)
+  mean_abs_error = sum(stat.mean) / len(stat.mean)
+  mean_square_error = sum(stat.sum2) / (len(stat.sum2) *
+                                         diff.size[0] * diff.size[1])
+  if mean_square_error == 0:
+    psnr = float('inf')
+  else:
+    psnr = 10 * math.log10(255 ** 2 / mean_square_error)
+  return mean_abs_error, psnr
+
+
+def main(file_locations):
+  print '%-40s %10s %10s %10s %10s' % ('image', 'full (s)', 'fast (s)',
+                                       'MAE', 'PSNR (dB)')
+  for seed, file_location in enumerate(file_locations):
+    full_image, full_time = RunPipeline(file_location, False, seed)
+    fast_image, fast_time = RunPipeline(file_location, True, seed)
+    mean_abs_error, psnr = CompareImages(full_image, fast_image)
+    print '%-40s %10.3f %10.3f %10.2f %10.2f' % (file_location[-40:],
+                                                 full_time, fast_time,
+                                                 mean_abs_error, psnr)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print __doc__
+    sys.exit(1)
+  main(sys.argv[1:])
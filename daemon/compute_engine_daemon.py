@@ -18,24 +18,42 @@ from BaseHTTPServer import BaseHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
 from datetime import datetime
 from httplib import BadStatusLine
+from httplib import HTTPException
+import hashlib
 import json
 import logging
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+from multiprocessing import TimeoutError as PoolTimeoutError
 import os
 import socket
+import tempfile
 import thread
 import threading
 from time import sleep
 from time import time
-from urllib import urlencode
-import urllib2
 
 from apiclient.discovery import build
 from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest
 import boto
 import httplib2
 from oauth2client.client import SignedJwtAssertionCredentials
 
-from image_processing import ConvertToBitifiedImage
+from batcher import Batcher
+from connection_pool import ConnectionPool
+from connection_pool import HttpConnectionPool
+from image_processing import ConvertToBitifiedPng
+from image_processing import quotes
+from lane_scheduler import LaneScheduler
+from lease_controller import LeaseController
+from profiling import ProfileReport
+from profiling import RunProfiled
+from profiling import ShouldProfile
+from profiling import StageTimings
+from result_cache import LocalCacheTier
+from result_cache import ResultCache
+from result_cache import ResultCacheKey
 import settings
 
 
@@ -48,16 +66,25 @@ TASK_FAIL = 2
 NO_TASKS = 3
 TASK_RATE_LIMITTED = 4  # HttpErro(403) RateLimit error returned.
 
-# Authorization
-http = SignedJwtAssertionCredentials(
-    settings.CREDENTIAL_ACCOUNT_EMAIL,
-    file(settings.PRIVATE_KEY_LOCATION, 'rb').read(),
-    scope='https://www.googleapis.com/auth/taskqueue')
-http = http.authorize(httplib2.Http())
-task_api = build('taskqueue', 'v1beta2', http=http)
+# Key under which a leased task records the lane queue it was leased from.
+TASK_QUEUE_KEY = 'leasedFromQueue'
+
+# Taskqueue API client, and keep-alive connections shared by all threads for
+# the taskqueue API and for Cloud Storage uploads. Set up by
+# ConnectServices().
+task_api = None
+task_api_connections = None
+storage_connections = None
+# Keep-alive connections for plain HTTP(S) requests (image downloads and GAE
+# callbacks).
+http_connections = HttpConnectionPool(settings.MAX_CONNECTIONS_PER_HOST,
+                                      settings.HTTP_TIMEOUT_SEC)
 
 DATETIME_STRSAFE = '%Y-%m-%d %H:%M:%S'
 
+# Size of the chunks image downloads are read in.
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
 # Heartbeat monitor statistics
 # NOTE: numTasksProcessedLastMin is the total number of tasks processed in
 #       the previous minute which ended prior to the current time, from
@@ -70,29 +97,121 @@ DATETIME_STRSAFE = '%Y-%m-%d %H:%M:%S'
 STATS = {
     'numTasksProcessing': 0,
     'numTasksProcessedLastMin': 0,
-    'lastLeasedDate': None
+    'lastLeasedDate': None,
+    'numLeasesRenewed': 0,
+    'numLeasesLost': 0,
+    'numDeleteFailures': 0,
+    'lastDeleteBatchSize': 0,
+    'lastDeleteBatchSec': None
 }
 # Tracks number of tasks complete in last minute, reset at at the end of the
 # minute.
 task_complete_counter = 0
+# Guards STATS and task_complete_counter, which task threads update.
+stats_lock = threading.Lock()
+
+# Number of leased tasks whose images are not yet processed and uploaded.
+# Task threads notify the condition as they free their slots so the lease
+# loop can refill them.
+tasks_in_flight = 0
+task_slot_available = threading.Condition()
+
+# Processed object names by image content and processing settings. Set up
+# by StartDaemonThreads().
+result_cache = None
+
+# Keeps leases on in-flight tasks from expiring. Started by
+# StartDaemonThreads().
+lease_renewer = None
+
+# Coalesce metadata updates sent to the GAE app and task deletions.
+# Started by StartDaemonThreads().
+metadata_batcher = None
+task_deleter = None
+
+# Adapts poll interval, lease count and lease time to the observed load.
+lease_controller = LeaseController()
+
+# Shares leases between the priority lane queues.
+lane_scheduler = LaneScheduler(settings.TASK_QUEUE_LANES)
+
+# Seconds spent per task in each pipeline stage.
+stage_timings = StageTimings(settings.STAGE_HISTOGRAM_SIZE)
+
+# Image worker processes and the semaphore bounding how many images are
+# handed to them at once. Created by StartImagePool().
+image_pool = None
+image_pool_size = 0
+image_pool_slots = None
+
+
+#########
+# Image worker pool
+def StartImagePool():
+  """Starts the long-lived image worker processes."""
+  global image_pool, image_pool_size, image_pool_slots
+  pool_size = settings.IMAGE_POOL_SIZE or cpu_count()
+  queue_depth = settings.IMAGE_POOL_QUEUE_DEPTH or 2 * pool_size
+  image_pool = Pool(pool_size)
+  image_pool_size = pool_size
+  image_pool_slots = threading.BoundedSemaphore(queue_depth)
+  logging.info('Started %d image worker processes (queue depth %d).',
+               pool_size, queue_depth)
+
+
+def ProcessImageInPool(image_data, filepath, profile=False):
+  """Bitifies an image in a worker process and returns it PNG-encoded.
+
+  Records the worker's per-stage timings, and the time spent waiting for a
+  worker as the 'poolWait' stage.
+  """
+  time_start = time()
+  image_pool_slots.acquire()
+  try:
+    result = image_pool.apply_async(ConvertToBitifiedPng,
+                                    (image_data, filepath, profile))
+    processed_image_data, timings = result.get(
+        settings.IMAGE_POOL_TIMEOUT_SEC)
+  finally:
+    image_pool_slots.release()
+  stage_timings.RecordAll(timings)
+  stage_timings.Record('poolWait',
+                       max(0, time() - time_start - sum(timings.values())))
+  return processed_image_data
 
 
 #########
 # Taskqueue manipulation
-def GetTasks():
-  """Pull next set of tasks off the queue."""
+def ExecuteTaskApiRequest(request):
+  """Executes a taskqueue API request over a pooled connection."""
+  with task_api_connections.Connection() as task_api_http:
+    return request.execute(http=task_api_http)
+
+
+def TaskQueueName(task):
+  """Returns the name of the queue a leased task came from."""
+  return task[TASK_QUEUE_KEY]
+
+
+def GetTasks(queue_name,
+             num_tasks=settings.NUM_TASKS_TO_LEASE,
+             lease_time_sec=settings.LEASE_TIME_SEC):
+  """Pull next set of tasks off the given queue."""
 
   try:
-    tasks = task_api.tasks().lease(leaseSecs=settings.LEASE_TIME_SEC,
-                                   taskqueue=settings.QUEUE_NAME,
+    tasks = task_api.tasks().lease(leaseSecs=lease_time_sec,
+                                   taskqueue=queue_name,
                                    project='s~'+settings.PROJECT_ID,
-                                   numTasks=settings.NUM_TASKS_TO_LEASE)
-    tasks = tasks.execute().get('items', [])
+                                   numTasks=num_tasks)
+    tasks = ExecuteTaskApiRequest(tasks).get('items', [])
+    for task in tasks:
+      task[TASK_QUEUE_KEY] = queue_name
     if tasks:
 
       # Update Stats.
-      STATS['numTasksProcessing'] += len(tasks)
-      STATS['lastLeasedDate'] = datetime.now().strftime(DATETIME_STRSAFE)
+      with stats_lock:
+        STATS['numTasksProcessing'] += len(tasks)
+        STATS['lastLeasedDate'] = datetime.now().strftime(DATETIME_STRSAFE)
     return TASK_PASS, tasks
   except HttpError, http_error:
     logging.error('HttpError %s: \'%s\'',
@@ -121,15 +240,103 @@ def GetTasks():
     return TASK_FAIL, None
 
 
+def GetLeaseDeadline(task, lease_time_sec):
+  """Returns the epoch time at which the lease on the given task expires."""
+  if 'leaseTimestamp' in task:
+    # Reported by the taskqueue API in microseconds since the epoch.
+    return float(task['leaseTimestamp']) / 1e6
+  return time() + lease_time_sec
+
+
+def RenewLease(task, lease_time_sec):
+  """Extend the lease on the given task, returning the new deadline."""
+
+  body = dict(task)
+  del body[TASK_QUEUE_KEY]
+  try:
+    renewed_task = ExecuteTaskApiRequest(
+        task_api.tasks().patch(project='s~'+settings.PROJECT_ID,
+                               taskqueue=TaskQueueName(task),
+                               task=task['id'],
+                               newLeaseSeconds=lease_time_sec,
+                               body=body))
+    return GetLeaseDeadline(renewed_task, lease_time_sec)
+  except HttpError, http_error:
+    logging.error('Error renewing lease on task %s: %s',
+                  task['id'],
+                  http_error)
+    return None
+  except Exception, e:
+    logging.error('Error renewing lease: %s', e)
+    return None
+
+
+class LeaseRenewer(threading.Thread):
+  """Extends leases on in-flight tasks shortly before they expire."""
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.lock = threading.Lock()
+    # Task id -> [task, lease deadline] for every task being worked on.
+    self.leases = {}
+
+  def Track(self, task, lease_time_sec):
+    """Starts keeping the lease on a newly leased task alive."""
+    with self.lock:
+      self.leases[task['id']] = [task, GetLeaseDeadline(task, lease_time_sec)]
+
+  def Untrack(self, task):
+    """Stops renewing the lease on a finished task."""
+    with self.lock:
+      self.leases.pop(task['id'], None)
+
+  def run(self):
+    while True:
+      sleep(settings.LEASE_RENEWAL_INTERVAL_SEC)
+      self.RenewExpiringLeases()
+
+  def RenewExpiringLeases(self):
+    """Renews every lease that expires within LEASE_RENEWAL_MARGIN_SEC."""
+    renew_before = time() + settings.LEASE_RENEWAL_MARGIN_SEC
+    with self.lock:
+      expiring = [(task, deadline) for task, deadline in self.leases.values()
+                  if deadline < renew_before]
+
+    for task, deadline in expiring:
+      new_deadline = None
+      if deadline > time():
+        new_deadline = RenewLease(task, lease_controller.lease_time_sec)
+
+      with self.lock:
+        if task['id'] not in self.leases:
+          # Task finished while renewing.
+          continue
+        if new_deadline:
+          self.leases[task['id']][1] = new_deadline
+        else:
+          # The task may now be leased and processed by another worker.
+          del self.leases[task['id']]
+      with stats_lock:
+        if new_deadline:
+          STATS['numLeasesRenewed'] += 1
+        else:
+          STATS['numLeasesLost'] += 1
+      if not new_deadline:
+        logging.error('Lost lease on task %s.', task['id'])
+
+
 def DeleteTask(task):
   """Delete the given task from the queue."""
 
   try:
-    task_api.tasks().delete(project='s~'+settings.PROJECT_ID,
-                            taskqueue=settings.QUEUE_NAME,
-                            task=task['id']).execute()
+    ExecuteTaskApiRequest(
+        task_api.tasks().delete(project='s~'+settings.PROJECT_ID,
+                                taskqueue=TaskQueueName(task),
+                                task=task['id']))
     # Update Stats. (Decrement to zero)
-    STATS['numTasksProcessing'] = max(0, STATS['numTasksProcessing'] - 1)
+    with stats_lock:
+      STATS['numTasksProcessing'] = max(0, STATS['numTasksProcessing'] - 1)
     return True
   except HttpError, http_error:
     logging.error('Error deleting task %s from taskqueue: %s',
@@ -141,158 +348,377 @@ def DeleteTask(task):
     return False
 
 
-def DoTask(task):
-  """Load, process and upload task image and return processed image link."""
+def DeleteTaskBatch(tasks):
+  """Delete the given tasks with one batch request.
+
+  Tasks whose deletion failed in the batch are retried one by one. Returns a
+  list of booleans, True for each task that was deleted.
+  """
+  errors = {}
+
+  def DeleteCallback(request_id, unused_response, exception):
+    errors[request_id] = exception
+
+  batch = BatchHttpRequest(callback=DeleteCallback,
+                           batch_uri=settings.TASK_API_BATCH_URL)
+  for index, task in enumerate(tasks):
+    batch.add(task_api.tasks().delete(project='s~'+settings.PROJECT_ID,
+                                      taskqueue=TaskQueueName(task),
+                                      task=task['id']),
+              request_id=str(index))
+
+  time_batch_start = time()
+  try:
+    ExecuteTaskApiRequest(batch)
+  except Exception, e:
+    logging.error('Error deleting task batch: %s', e)
+  time_batch = time()-time_batch_start
+
+  results = []
+  num_deleted = 0
+  for index, task in enumerate(tasks):
+    request_id = str(index)
+    if request_id in errors and errors[request_id] is None:
+      num_deleted += 1
+      results.append(True)
+    else:
+      logging.warning('Retrying deletion of task %s: %s',
+                      task['id'],
+                      errors.get(request_id))
+      results.append(DeleteTask(task))
+
+  with stats_lock:
+    STATS['numTasksProcessing'] = max(0,
+                                      STATS['numTasksProcessing'] -
+                                      num_deleted)
+    STATS['numDeleteFailures'] += results.count(False)
+    STATS['lastDeleteBatchSize'] = len(tasks)
+    STATS['lastDeleteBatchSec'] = time_batch
+  return results
+
+
+class StorageCacheTier(object):
+  """Shared result cache tier, kept as small objects in Cloud Storage.
+
+  Each entry is an object named RESULT_CACHE_PREFIX + key in
+  PROCESSED_IMG_BUCKET, holding the processed object name.
+  """
+
+  def Get(self, key):
+    with storage_connections.Connection() as storage_connection:
+      bucket = storage_connection.get_bucket(settings.PROCESSED_IMG_BUCKET,
+                                             validate=False)
+      cache_entry = bucket.get_key(settings.RESULT_CACHE_PREFIX + key)
+      if cache_entry:
+        return cache_entry.get_contents_as_string()
+      return None
+
+  def Set(self, key, value):
+    with storage_connections.Connection() as storage_connection:
+      bucket = storage_connection.get_bucket(settings.PROCESSED_IMG_BUCKET,
+                                             validate=False)
+      cache_entry = bucket.new_key(settings.RESULT_CACHE_PREFIX + key)
+      cache_entry.set_contents_from_string(value)
+
+
+def DownloadImage(url):
+  """Reads the image at url into memory, hashing its content on the way.
+
+  Images larger than IMAGE_SPILL_THRESHOLD_BYTES are written to a temporary
+  file instead. Returns (image_data, None, content_hash) or
+  (None, filepath, content_hash); the caller removes the file. Raises
+  IOError or httplib.HTTPException if the download failed.
+  """
+  content_hash = hashlib.sha1()
+  with http_connections.Request(url) as image_request:
+    if image_request.status != 200:
+      raise IOError('HTTP Error %d: %s' % (image_request.status,
+                                           image_request.reason))
+    chunks = []
+    size = 0
+    spill = False
+    while True:
+      chunk = image_request.read(DOWNLOAD_CHUNK_BYTES)
+      if not chunk:
+        break
+      content_hash.update(chunk)
+      chunks.append(chunk)
+      size += len(chunk)
+      if (settings.IMAGE_SPILL_THRESHOLD_BYTES and
+          size > settings.IMAGE_SPILL_THRESHOLD_BYTES):
+        spill = True
+        break
+    if not spill:
+      return ''.join(chunks), None, content_hash.digest()
+
+    # Spill to disk, writing what has been read so far then the rest.
+    file_handle = tempfile.NamedTemporaryFile(prefix='smashpix_',
+                                              delete=False)
+    try:
+      with file_handle:
+        file_handle.writelines(chunks)
+        while True:
+          chunk = image_request.read(DOWNLOAD_CHUNK_BYTES)
+          if not chunk:
+            break
+          content_hash.update(chunk)
+          file_handle.write(chunk)
+    except (IOError, HTTPException):
+      os.remove(file_handle.name)
+      raise
+    return None, file_handle.name, content_hash.digest()
+
+
+def DoTask(task, profile=False):
+  """Load, process and upload task image and return processed image link.
+
+  With profile set, the image worker also profiles its processing.
+  """
 
   payload = json.loads(base64.b64decode(task['payloadBase64']))
 
   # Load Image from URL
   url = payload['image_link']
 
-  # Save image temporarily for upload with timestamp as name
+  # Name processed image with timestamp
   filename = '%s_%s' % (url[url.rfind('/')+1:],
                         datetime.strftime(datetime.now(),
                                           '%Y_%M_%d_%H_%M_%S_%s'))
 
-  filepath = os.path.join('/tmp', filename)
-
-  # Save image to temporary file
   try:
-    image_request = urllib2.urlopen(url)
-    with open(filepath, 'wb') as file_handle:
-      file_handle.write(image_request.read())
-  except urllib2.HTTPError, e:
+    with stage_timings.Time('download'):
+      image_data, filepath, content_hash = DownloadImage(url)
+  except (IOError, HTTPException), e:
     logging.error('Error loading image link %s : %s', url, e)
     return False
 
-  # Generate Bitified image from given image.
+  # Reuse the processed image of an earlier upload with the same content.
+  cache_key = ResultCacheKey(content_hash, quotes)
+  cached_name = result_cache.Get(cache_key)
+  if cached_name:
+    if filepath:
+      os.remove(filepath)
+    logging.info('Reusing processed image "%s/%s" for %s',
+                 settings.PROCESSED_IMG_BUCKET,
+                 cached_name,
+                 url)
+    return cached_name
+
+  # Generate Bitified image from given image in a worker process.
   try:
-    processed_image = ConvertToBitifiedImage(filepath)
+    processed_image_data = ProcessImageInPool(image_data, filepath, profile)
   except IOError, e:
     logging.error('Error processing image for %s : %s', url, e)
     return False
-
-  filepath_processed_image = filepath+'.png'
-
-  try:
-    processed_image.save(filepath_processed_image)
-  except IOError, e:
-    logging.error('Error saving processed image for %s : %s', url, e)
+  except PoolTimeoutError:
+    logging.error('Timed out processing image for %s', url)
     return False
+  finally:
+    # Remove spilled image, if any
+    if filepath:
+      os.remove(filepath)
 
   # Upload processed image to bitified image cloud bucket
-  contents = file(filepath_processed_image, 'r')
-  uri = boto.storage_uri(settings.PROCESSED_IMG_BUCKET + '/' + filename,
-                         settings.GOOGLE_STORAGE)
-  uri.new_key().set_contents_from_file(contents)
-
-  contents.close()
-
-  # Remove temporary image
-  os.remove(filepath)
+  with stage_timings.Time('upload'):
+    with storage_connections.Connection() as storage_connection:
+      bucket = storage_connection.get_bucket(settings.PROCESSED_IMG_BUCKET,
+                                             validate=False)
+      key = bucket.new_key(filename)
+      key.set_contents_from_string(processed_image_data)
+  result_cache.Set(cache_key, key.name)
 
   logging.info('%s - Successfully created "%s/%s"\n',
                datetime.now(),
-               uri.bucket_name,
-               uri.object_name)
+               bucket.name,
+               key.name)
 
-  return uri.object_name
+  return key.name
 
 
 class TaskThread(threading.Thread):
   def __init__(self, task):
     threading.Thread.__init__(self)
     self.task = task
-    self.status = TASK_PASS
 
   def run(self):
-    """Process the single task, ping GAE app, and delete task from queue."""
+    """Process the single task, ping GAE app, and delete task from queue.
+
+    The task frees its slot once its image is uploaded, so the metadata update
+    and the delete wait for their batches without holding back new leases.
+    The task is only deleted once the app accepted its update; otherwise it
+    is leased again when its lease expires.
+    """
     task = self.task
-    # Perform image processing for Task
     time_task_start = time()
-    processed_image_name = DoTask(task)
-    time_task = time()-time_task_start
-    if processed_image_name:
-      logging.info('Task successful: %g seconds', time_task)
-      individual_task_status = True
-    else:
-      logging.error('Task failed: %g seconds', time_task)
-      individual_task_status = False
-      processed_image_name = ''
-
-    # GAE Notification
-    data = dict(status=individual_task_status,
-                image_8bit_name=processed_image_name)
-    resp, content = SendUpdatedMetadataToApp(task, data)
-
-    if resp['status'] == '200':
-      logging.info('Successfully sent metadata to App.')
-    else:
-      logging.error('Unexpected Google App Engine Response: %s, %s',
-                    resp,
-                    content)
-      self.status = TASK_FAIL
-
+    metadata_sent = False
+    try:
+      # Perform image processing for Task, sometimes under the profiler.
+      try:
+        if ShouldProfile():
+          processed_image_name = RunProfiled('task', DoTask, task, True)
+        else:
+          processed_image_name = DoTask(task)
+      except Exception, e:
+        logging.exception('Error processing task %s: %s', task['id'], e)
+        processed_image_name = False
+      finally:
+        FinishTask()
+      time_task = time()-time_task_start
+      if processed_image_name:
+        logging.info('Task successful: %g seconds', time_task)
+        individual_task_status = True
+      else:
+        logging.error('Task failed: %g seconds', time_task)
+        individual_task_status = False
+        processed_image_name = ''
+
+      # GAE Notification
+      data = dict(status=individual_task_status,
+                  image_8bit_name=processed_image_name)
+      with stage_timings.Time('callback'):
+        status, content = SendUpdatedMetadataToApp(task, data)
+
+      if status == 200:
+        logging.info('Successfully sent metadata to App.')
+        metadata_sent = True
+        lane_scheduler.RecordTaskDone(TaskQueueName(task), task)
+      else:
+        logging.error('Unexpected Google App Engine Response: %s, %s',
+                      status,
+                      content)
+    except Exception, e:
+      logging.exception('Error sending metadata for task %s: %s',
+                        task['id'], e)
+    finally:
+      # The lease has to cover everything up to the delete.
+      lease_controller.RecordTaskTime(time()-time_task_start)
+
+      # Delete Task as soon as it is done, batched with other finished tasks.
+      # The lease is kept alive until the deletion went through.
+      if metadata_sent:
+        with stage_timings.Time('delete'):
+          if task_deleter.Send(task):
+            logging.info('Deleted task.')
+      else:
+        logging.warning('Leaving task %s to be leased again.', task['id'])
+        with stats_lock:
+          STATS['numTasksProcessing'] = max(0,
+                                            STATS['numTasksProcessing'] - 1)
+      lease_renewer.Untrack(task)
+      stage_timings.Record('task', time()-time_task_start)
+
+
+def FinishTask():
+  """Counts a processed task and frees its slot for the lease loop."""
+  global task_complete_counter, tasks_in_flight
+  with stats_lock:
+    task_complete_counter += 1
+  with task_slot_available:
+    tasks_in_flight -= 1
+    task_slot_available.notify()
+
+
+def MaxTasksInFlight():
+  return settings.MAX_TASKS_IN_FLIGHT or 2 * image_pool_size
+
+
+def WaitForTaskSlots():
+  """Blocks until a task slot is free and returns the number of free slots."""
+  max_tasks_in_flight = MaxTasksInFlight()
+  with task_slot_available:
+    while tasks_in_flight >= max_tasks_in_flight:
+      task_slot_available.wait()
+    return max_tasks_in_flight - tasks_in_flight
+
+
+def LeaseAndStartTasks():
+  """Lease tasks for any free slots and start a thread for each of them.
+
+  Lanes are tried in the order the lane scheduler gives, until one of them
+  has tasks.
+  """
+  global tasks_in_flight
+  free_slots = WaitForTaskSlots()
+  lease_time_sec = lease_controller.lease_time_sec
+  for lane in lane_scheduler.LanesInOrder():
+    num_tasks = min(free_slots, lease_controller.lease_count,
+                    lane_scheduler.MaxLeaseCount(lane, MaxTasksInFlight()))
+    with stage_timings.Time('lease'):
+      tasks_query_status, tasks = GetTasks(lane.queue_name, num_tasks,
+                                           lease_time_sec)
+    if tasks_query_status != TASK_PASS:
+      break
+    lane_scheduler.RecordLease(lane, tasks)
+    if tasks:
+      break
 
-def DoTaskBatch():
-  """Check for tasks, do tasks, store stats, rinse and repeat."""
-  global task_complete_counter
-  tasks_query_status, tasks = GetTasks()
   if tasks_query_status == TASK_PASS:
+    lease_controller.RecordLease(num_tasks, len(tasks))
     if not tasks:
       logging.debug('No tasks in queue.')
       return NO_TASKS
 
-    logging.info('Recieved %g tasks.', len(tasks))
-    # Initial status is all passed.
-    aggregate_task_status = TASK_PASS
+    logging.info('Recieved %g tasks from %s.', len(tasks), lane.queue_name)
+    with task_slot_available:
+      tasks_in_flight += len(tasks)
 
-    # For each task, create a a new thread, start it and add it to a
-    # list of threads.
-    threads = []
+    # Each task runs in its own thread and frees its slot when done.
     for task in tasks:
-      task_thread = TaskThread(task)
-      task_thread.start()
-      threads.append(task_thread)
-
-    # Wait for all the threads to complete.
-    for task_thread in threads:
-      task_thread.join()
+      lease_renewer.Track(task, lease_time_sec)
+      TaskThread(task).start()
+    return TASK_PASS
+  elif tasks_query_status == TASK_RATE_LIMITTED:
+    lease_controller.RecordRateLimit()
+    return TASK_RATE_LIMITTED
+  else:
+    logging.error('Task lease failed.')
+    lease_controller.RecordFailure()
+    return TASK_FAIL
 
-    # Delete all the tasks processed.
-    for task in tasks:
-      # Delete Task
-      if DeleteTask(task):
-        logging.info('Deleted task.')
-      else:
-        aggregate_task_status = TASK_FAIL
 
-      # Increment task counter
-      task_complete_counter += 1
+def UpdateLaneBacklogs():
+  """Fetches the number of tasks waiting in each lane queue."""
+  for lane in lane_scheduler.lanes:
+    try:
+      queue = ExecuteTaskApiRequest(
+          task_api.taskqueues().get(project='s~'+settings.PROJECT_ID,
+                                    taskqueue=lane.queue_name,
+                                    getStats=True))
+      lane_scheduler.SetBacklog(lane.queue_name,
+                                queue.get('stats', {}).get('totalTasks'))
+    except Exception, e:
+      logging.error('Error getting stats of queue %s: %s',
+                    lane.queue_name, e)
 
-    # Aggregate end status of all the task threads.
-    for task_thread in threads:
-      if task_thread.status == TASK_FAIL:
-        aggregate_task_status = TASK_FAIL
 
-    return aggregate_task_status
-  elif tasks_query_status == TASK_FAIL:
-    logging.error('Task Batch Failed.')
-    return TASK_FAIL
-  else:
-    return tasks_query_status
+def PollLaneBacklogs():
+  """Refreshes the lane backlogs every LANE_BACKLOG_INTERVAL_SEC."""
+  while True:
+    UpdateLaneBacklogs()
+    sleep(settings.LANE_BACKLOG_INTERVAL_SEC)
 
 
 def SendUpdatedMetadataToApp(task, data):
-  """Does http post to GAE app with the task and it's metadata."""
+  """Sends the task's metadata to the GAE app, batched with other tasks'.
+
+  Blocks until the batch containing it has been posted and returns the
+  response status and content.
+  """
   payload = json.loads(base64.b64decode(task['payloadBase64']))
 
   # Add key to the data sent.
   data['id'] = payload['key']
-  url = 'https://%s.appspot.com/update' % settings.PROJECT_ID
-  return httplib2.Http().request(url,
-                                 'POST',
-                                 urlencode(data))
+  return metadata_batcher.Send(data) or (None, 'Metadata batch not sent.')
+
+
+def SendMetadataBatchToApp(updates):
+  """Does http post to GAE app with a list of task metadata updates."""
+  url = settings.APP_URL + '/update/batch'
+  with http_connections.Request(
+      url, 'POST', json.dumps(updates),
+      {'Content-Type': 'application/json'}) as response:
+    result = response.status, response.read()
+  return [result] * len(updates)
 
 
 #########
@@ -313,17 +739,100 @@ def HeartbeatServe():
 
 
 class HeartbeatHandler(BaseHTTPRequestHandler):
-  """Heartbeat GCE Statistics Handler."""
+  """Heartbeat GCE Statistics Handler.
+
+  Serves statistics as JSON, stage timings in Prometheus text format under
+  /metrics, and the sampled cProfile report under /profile.
+  """
 
   def do_GET(self):  # pylint: disable=g-bad-name
+    if self.path == '/metrics':
+      self.WriteText(stage_timings.PrometheusText('smashpix_stage_seconds'))
+      return
+    elif self.path == '/profile':
+      self.WriteText(ProfileReport())
+      return
+
     self.send_response(200)
     self.send_header('Content-type', 'application/json')
     self.end_headers()
 
     # Return Heartbeat statistics
-    self.wfile.write(json.dumps(STATS))
+    with stats_lock:
+      stats = dict(STATS)
+    stats['leaseController'] = lease_controller.Stats()
+    stats['lanes'] = lane_scheduler.Stats()
+    stats['stages'] = stage_timings.Stats()
+    stats['resultCache'] = result_cache.Stats()
+    stats['connections'] = {
+        'taskApi': task_api_connections.Stats(),
+        'http': http_connections.Stats(),
+        'storage': storage_connections.Stats()
+    }
+    self.wfile.write(json.dumps(stats))
     return
 
+  def WriteText(self, text):
+    self.send_response(200)
+    self.send_header('Content-type', 'text/plain; version=0.0.4')
+    self.end_headers()
+    self.wfile.write(text)
+
+
+#########
+# Setup
+def ConnectServices(authorize, connect_storage):
+  """Creates the taskqueue API client and the service connection pools.
+
+  authorize returns the given httplib2.Http set up to send authorized
+  requests, and connect_storage returns a new boto Cloud Storage connection.
+  """
+  global task_api, task_api_connections, storage_connections
+  task_api = build('taskqueue', 'v1beta2',
+                   http=authorize(httplib2.Http()),
+                   discoveryServiceUrl=settings.TASK_API_DISCOVERY_URL)
+  task_api_connections = ConnectionPool(
+      lambda: authorize(httplib2.Http(timeout=settings.HTTP_TIMEOUT_SEC)),
+      settings.MAX_CONNECTIONS_PER_HOST)
+  storage_connections = ConnectionPool(connect_storage,
+                                       settings.MAX_CONNECTIONS_PER_HOST)
+
+
+def StartDaemonThreads():
+  """Sets up the result cache and starts the daemon's background threads."""
+  global result_cache, lease_renewer, metadata_batcher, task_deleter
+
+  # Set up the processed image cache, shared between daemons if configured.
+  if settings.RESULT_CACHE_SHARED:
+    shared_cache_tier = StorageCacheTier()
+  else:
+    shared_cache_tier = None
+  result_cache = ResultCache(LocalCacheTier(settings.RESULT_CACHE_SIZE),
+                             shared_cache_tier)
+
+  # Start renewing leases of in-flight tasks in separate thread.
+  lease_renewer = LeaseRenewer()
+  lease_renewer.start()
+
+  # Start sending metadata update and task deletion batches in separate
+  # threads.
+  metadata_batcher = Batcher('metadata update',
+                             SendMetadataBatchToApp,
+                             settings.UPDATE_BATCH_MAX_SIZE,
+                             settings.UPDATE_BATCH_WINDOW_SEC)
+  metadata_batcher.start()
+  task_deleter = Batcher('task deletion',
+                         DeleteTaskBatch,
+                         settings.DELETE_BATCH_MAX_SIZE,
+                         settings.DELETE_BATCH_WINDOW_SEC)
+  task_deleter.start()
+
+  # Start refreshing the lane backlogs reported by the heartbeat server.
+  thread.start_new_thread(PollLaneBacklogs, ())
+
+  # Start heartbeat poll handler in separate thread.
+  thread.start_new_thread(HeartbeatServe, ())
+
 
 #########
 # Main Logic
@@ -342,35 +851,38 @@ def main():
 
     # If a minute has gone by.
     if time() - t_tasks_per_min >= 60:
-      logging.info('Number of tasks completed in last minute: %g',
-                   task_complete_counter)
-      STATS['numTasksProcessedLastMin'] = task_complete_counter
-      task_complete_counter = 0
+      with stats_lock:
+        logging.info('Number of tasks completed in last minute: %g',
+                     task_complete_counter)
+        STATS['numTasksProcessedLastMin'] = task_complete_counter
+        task_complete_counter = 0
       t_tasks_per_min = time()
 
-    # Initialize number of tasks complete in one cycle
-    result = DoTaskBatch()
+    # Keep leasing while there are free slots, backing off as the lease
+    # controller decides when the queue is empty, failing or rate limitted.
+    result = LeaseAndStartTasks()
+    sleep_time = lease_controller.poll_interval_sec
     if result == TASK_PASS:
-      logging.debug('Sleeping for %g seconds...',
-                    settings.SLEEP_TIME_AFTER_TASKS_SEC)
-      sleep(settings.SLEEP_TIME_AFTER_TASKS_SEC)
+      continue
     elif result == NO_TASKS:
-      logging.debug('Sleeping for %g seconds...',
-                    settings.SLEEP_TIME_AFTER_NO_TASKS_SEC)
-      sleep(settings.SLEEP_TIME_AFTER_NO_TASKS_SEC)
+      logging.debug('Sleeping for %g seconds...', sleep_time)
     elif result == TASK_RATE_LIMITTED:
-      logging.debug('Sleeping for %g seconds...',
-                    settings.SLEEP_TIME_RATE_LIMIT)
-      sleep(settings.SLEEP_TIME_RATE_LIMIT)
+      logging.debug('Rate limitted. Sleeping for %g seconds...', sleep_time)
     else:
-      logging.debug('Task failed. Sleeping for %g seconds...',
-                    settings.SLEEP_TIME_AFTER_NO_TASKS_SEC)
-      sleep(settings.SLEEP_TIME_AFTER_NO_TASKS_SEC)
+      logging.debug('Task failed. Sleeping for %g seconds...', sleep_time)
+    sleep(sleep_time)
 
 
 if __name__ == '__main__':
-  # Start heartbeat poll handler in separate thread.
-  thread.start_new_thread(HeartbeatServe, ())
+  # Start image worker processes before any other threads are running.
+  StartImagePool()
+
+  credentials = SignedJwtAssertionCredentials(
+      settings.CREDENTIAL_ACCOUNT_EMAIL,
+      file(settings.PRIVATE_KEY_LOCATION, 'rb').read(),
+      scope='https://www.googleapis.com/auth/taskqueue')
+  ConnectServices(credentials.authorize, boto.connect_gs)
+  StartDaemonThreads()
 
   # Start main task-queue chomping daemon
   main()
@@ -0,0 +1,160 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Thread-safe keep-alive connection pools used by GCE daemon."""
+
+from contextlib import contextmanager
+import httplib
+import socket
+import threading
+from urlparse import urljoin
+from urlparse import urlsplit
+
+# Response codes followed as redirects for GET requests.
+REDIRECT_CODES = (301, 302, 303, 307)
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool(object):
+  """Pool of reusable connection objects, at most max_size in use at once.
+
+  Connections are created with factory when no idle one is available. A
+  connection is dropped instead of returned to the pool if the block using it
+  raises.
+  """
+
+  def __init__(self, factory, max_size):
+    self.factory = factory
+    self.slots = threading.BoundedSemaphore(max_size)
+    self.lock = threading.Lock()
+    self.idle = []
+    self.num_opened = 0
+    self.num_reused = 0
+
+  @contextmanager
+  def Connection(self):
+    """Yields a connection for exclusive use by the calling thread."""
+    self.slots.acquire()
+    try:
+      with self.lock:
+        connection = self.idle.pop() if self.idle else None
+        if connection:
+          self.num_reused += 1
+        else:
+          self.num_opened += 1
+      if not connection:
+        connection = self.factory()
+
+      yield connection
+      with self.lock:
+        self.idle.append(connection)
+    finally:
+      self.slots.release()
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'numConnectionsOpened': self.num_opened,
+          'numConnectionsReused': self.num_reused
+      }
+
+
+class HttpConnectionPool(object):
+  """Keep-alive HTTP(S) connections, limited to max_per_host per host."""
+
+  def __init__(self, max_per_host, timeout):
+    self.max_per_host = max_per_host
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    # (scheme, host) -> ConnectionPool of httplib connections.
+    self.hosts = {}
+    self.num_requests = 0
+    self.num_sockets_opened = 0
+    self.num_sockets_reused = 0
+
+  def HostPool(self, scheme, host):
+    """Returns the connection pool for the given scheme and host."""
+    with self.lock:
+      if (scheme, host) not in self.hosts:
+        if scheme == 'https':
+          connection_class = httplib.HTTPSConnection
+        else:
+          connection_class = httplib.HTTPConnection
+        self.hosts[(scheme, host)] = ConnectionPool(
+            lambda: connection_class(host, timeout=self.timeout),
+            self.max_per_host)
+      return self.hosts[(scheme, host)]
+
+  @contextmanager
+  def Request(self, url, method='GET', body=None, headers=None):
+    """Sends a request and yields the httplib response, following redirects.
+
+    The connection goes back to the pool still open if the response body was
+    read to the end by the block, and is closed otherwise.
+    """
+    for _ in xrange(MAX_REDIRECTS + 1):
+      scheme, host, path, query, _ = urlsplit(url)
+      if query:
+        path += '?' + query
+      with self.HostPool(scheme, host).Connection() as connection:
+        response = self.Send(connection, method, path or '/', body,
+                             headers or {})
+        location = response.getheader('location')
+        if (method == 'GET' and response.status in REDIRECT_CODES and
+            location):
+          response.read()
+          self.Release(connection, response)
+          url = urljoin(url, location)
+          continue
+
+        try:
+          yield response
+        finally:
+          self.Release(connection, response)
+        return
+    raise httplib.HTTPException('Too many redirects for %s' % url)
+
+  def Send(self, connection, method, path, body, headers):
+    """Sends a request, retrying once if a kept-alive socket was closed."""
+    reused = connection.sock is not None
+    with self.lock:
+      self.num_requests += 1
+      if reused:
+        self.num_sockets_reused += 1
+      else:
+        self.num_sockets_opened += 1
+    try:
+      connection.request(method, path, body, headers)
+      return connection.getresponse()
+    except (httplib.HTTPException, socket.error):
+      connection.close()
+      if not reused:
+        raise
+    with self.lock:
+      self.num_sockets_opened += 1
+    connection.request(method, path, body, headers)
+    return connection.getresponse()
+
+  def Release(self, connection, response):
+    """Closes the socket unless it can carry another request."""
+    if not response.isclosed() or response.will_close:
+      connection.close()
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'numRequests': self.num_requests,
+          'numSocketsOpened': self.num_sockets_opened,
+          'numSocketsReused': self.num_sockets_reused
+      }
@@ -0,0 +1,164 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for image_processing.py.
+
+Optimized functions are compared with the straightforward implementations
+they replaced, whose output they must match pixel for pixel. Run from this
+directory, as image_processing loads QUOTES_FILE_LOCATION and FONT_TTF when
+imported: python -m unittest image_processing_test
+"""
+
+import random
+import unittest
+
+import Image
+import ImageChops
+import ImageDraw
+
+import image_processing
+from result_cache import LocalCacheTier
+import settings
+
+# Sizes of the test images, including odd and degenerate ones.
+SIZES = [(1, 1), (7, 5), (64, 48), (333, 217), (320, 240)]
+
+# Quotes of several lengths, wrapped onto one or more lines.
+TEXTS = ['', 'x', 'Pixels all the way down.',
+         'Supercalifragilisticexpialidocious' * 3,
+         'The quick brown fox jumps over the lazy dog. ' * 6]
+
+
+def NoiseImage(size, seed, max_value=120):
+  """Returns an RGB image of random pixels, many of them near black."""
+  rand = random.Random(seed)
+  image = Image.new('RGB', size)
+  image.putdata([tuple(rand.randint(0, max_value) for _ in xrange(3))
+                 for _ in xrange(size[0] * size[1])])
+  return image
+
+
+def PerPixelLowPassFilter(image):
+  """The getpixel/putpixel loop LowPassFilter replaced."""
+  for x in xrange(image.size[0]):
+    for y in xrange(image.size[1]):
+      r, g, b = image.getpixel((x, y))
+      if r < 50 and g < 50 and b < 50:
+        image.putpixel((x, y), (0, 0, 0))
+      else:
+        image.putpixel((x, y), (r, g, b))
+  return image
+
+
+def FullImageDrawBlurredRectangle(image, bbox, alpha=0.6):
+  """The DrawBlurredRectangle that blended a copy of the whole image."""
+  other = image.copy()
+  draw = ImageDraw.Draw(other)
+  draw.rectangle([(bbox[0], bbox[1]), (bbox[2], bbox[3])],
+                 fill=settings.QUOTE_BG_COLOR)
+  return Image.blend(image, other, alpha)
+
+
+def DrawnAddTextToImage(image, text):
+  """The AddTextToImage that drew the quote onto each image."""
+  font = image_processing.FONT
+  draw = ImageDraw.Draw(image)
+  width, height = image.size
+  lines = image_processing.GetImageWrappedText(width, draw, text, font)
+  text_width, text_height = draw.textsize('A', font=font)
+  start_height_offset = max(10, text_height * len(lines))
+
+  image = FullImageDrawBlurredRectangle(image,
+                                        [0, height-10,
+                                         width,
+                                         height-start_height_offset-10])
+  draw = ImageDraw.Draw(image)
+  for line in lines:
+    text_width, text_height = draw.textsize(line, font=font)
+    draw.text(((width-text_width)/2, height-start_height_offset-10), line,
+              font=font,
+              fill=settings.QUOTE_TEXT_COLOR)
+    start_height_offset -= text_height
+  return image
+
+
+class ImageTestCase(unittest.TestCase):
+
+  def assertSameImage(self, expected, actual, msg=None):
+    self.assertEqual(expected.mode, actual.mode, msg)
+    self.assertEqual(expected.size, actual.size, msg)
+    self.assertIsNone(ImageChops.difference(expected, actual).getbbox(),
+                      msg or 'Images differ.')
+
+
+class LowPassFilterTest(ImageTestCase):
+
+  def testMatchesPerPixelLoop(self):
+    for seed, size in enumerate(SIZES):
+      image = NoiseImage(size, seed)
+      self.assertSameImage(PerPixelLowPassFilter(image.copy()),
+                           image_processing.LowPassFilter(image.copy()),
+                           'Differs at size %s.' % (size,))
+
+  def testKeepsPixelsAtThreshold(self):
+    image = Image.new('RGB', (4, 1))
+    image.putdata([(49, 49, 49), (50, 0, 0), (0, 49, 50), (10, 20, 30)])
+    self.assertEqual([(0, 0, 0), (50, 0, 0), (0, 49, 50), (0, 0, 0)],
+                     list(image_processing.LowPassFilter(image).getdata()))
+
+
+class DrawBlurredRectangleTest(ImageTestCase):
+
+  def testMatchesFullImageBlend(self):
+    rand = random.Random(0)
+    for seed, size in enumerate(SIZES):
+      image = NoiseImage(size, seed, max_value=255)
+      width, height = size
+      # Inverted, partly and wholly outside the image, and random boxes.
+      boxes = [[0, height-10, width, height-30], [2, 2, 5, 4],
+               [5, 4, 2, 2], [-5, -5, width+5, height+5],
+               [0, height+5, width, height+50], [width, 0, width, height],
+               [0, -20, width, -5]]
+      boxes += [[rand.randint(-20, width+20), rand.randint(-20, height+20),
+                 rand.randint(-20, width+20), rand.randint(-20, height+20)]
+                for _ in xrange(10)]
+      for bbox in boxes:
+        for alpha in (0.6, 0.3, 1.0):
+          self.assertSameImage(
+              FullImageDrawBlurredRectangle(image.copy(), bbox, alpha),
+              image_processing.DrawBlurredRectangle(image.copy(), bbox,
+                                                    alpha),
+              'Differs at size %s for %s, alpha %g.' % (size, bbox, alpha))
+
+
+class AddTextToImageTest(ImageTestCase):
+
+  def setUp(self):
+    image_processing.text_masks = LocalCacheTier(
+        image_processing.TEXT_MASK_CACHE_SIZE)
+
+  def testMatchesDrawnText(self):
+    for seed, size in enumerate(SIZES + [(768, 30)]):
+      image = NoiseImage(size, seed, max_value=255)
+      for text in TEXTS + image_processing.quotes[:3]:
+        expected = DrawnAddTextToImage(image.copy(), text)
+        # Rendered the first time, then composited from the cached mask.
+        for _ in xrange(2):
+          self.assertSameImage(
+              expected, image_processing.AddTextToImage(image.copy(), text),
+              'Differs at size %s for %r.' % (size, text))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Weighted fair leasing across priority lane queues used by GCE daemon."""
+
+import math
+import threading
+from time import time
+
+from profiling import Histogram
+import settings
+
+# Number of recent tasks per lane whose latencies are kept for percentiles.
+LATENCY_WINDOW_SIZE = 1000
+
+
+def TaskEnqueueTime(task):
+  """Returns the epoch time at which a leased task was enqueued, or None."""
+  if 'enqueueTimestamp' in task:
+    # Reported by the taskqueue API in microseconds since the epoch.
+    return float(task['enqueueTimestamp']) / 1e6
+  return None
+
+
+class Lane(object):
+  """A pull queue leased from with a share of capacity set by its weight."""
+
+  def __init__(self, queue_name, weight):
+    self.queue_name = queue_name
+    self.weight = weight
+    self.virtual_time = 0.0
+    # Time before which the lane is only polled if no other lane is due,
+    # after it came back empty.
+    self.idle_until = 0
+    self.num_leased = 0
+    self.backlog = None
+    # Seconds from enqueue to lease, and from enqueue to processed image.
+    self.wait_times_sec = Histogram(LATENCY_WINDOW_SIZE)
+    self.total_times_sec = Histogram(LATENCY_WINDOW_SIZE)
+
+
+class LaneScheduler(object):
+  """Orders lanes for leasing by start-time fair queueing.
+
+  Leasing n tasks from a lane advances its virtual time by n / weight, and
+  lanes are leased from lowest virtual time first, so under contention each
+  lane gets tasks in proportion to its weight. A lane that was idle restarts
+  from the current virtual time rather than claiming the capacity it did not
+  use, and a lane that came back empty is polled again only after
+  EMPTY_LANE_POLL_INTERVAL_SEC, unless every lane is idle.
+  """
+
+  def __init__(self, lanes):
+    self.lock = threading.Lock()
+    self.lanes = [Lane(queue_name, weight) for queue_name, weight in lanes]
+    self.lanes_by_name = dict((lane.queue_name, lane) for lane in self.lanes)
+    self.total_weight = float(sum(lane.weight for lane in self.lanes))
+    self.virtual_time = 0.0
+
+  def LanesInOrder(self):
+    """Returns the lanes to try leasing from, in order."""
+    now = time()
+    with self.lock:
+      lanes = [lane for lane in self.lanes if lane.idle_until <= now]
+      return sorted(lanes or self.lanes, key=lambda lane: lane.virtual_time)
+
+  def MaxLeaseCount(self, lane, capacity):
+    """Returns the most tasks to lease from a lane at once.
+
+    Capped at the lane's weighted share of capacity, so one lease cannot fill
+    every slot ahead of the other lanes.
+    """
+    return max(1, int(math.ceil(capacity * lane.weight / self.total_weight)))
+
+  def RecordLease(self, lane, tasks):
+    """Updates the lane's virtual time and wait times after a lease."""
+    now = time()
+    with self.lock:
+      if not tasks:
+        lane.idle_until = now + settings.EMPTY_LANE_POLL_INTERVAL_SEC
+        return
+      lane.idle_until = 0
+      start = max(lane.virtual_time, self.virtual_time)
+      self.virtual_time = start
+      lane.virtual_time = start + len(tasks) / float(lane.weight)
+      lane.num_leased += len(tasks)
+      for task in tasks:
+        enqueue_time = TaskEnqueueTime(task)
+        if enqueue_time:
+          lane.wait_times_sec.Add(now - enqueue_time)
+
+  def RecordTaskDone(self, queue_name, task):
+    """Records the time from enqueue to processed image for a task."""
+    enqueue_time = TaskEnqueueTime(task)
+    if enqueue_time:
+      with self.lock:
+        self.lanes_by_name[queue_name].total_times_sec.Add(
+            time() - enqueue_time)
+
+  def SetBacklog(self, queue_name, backlog):
+    with self.lock:
+      self.lanes_by_name[queue_name].backlog = backlog
+
+  def Stats(self):
+    """Returns per-lane counts and latency percentiles for the heartbeat."""
+    with self.lock:
+      stats = {}
+      for lane in self.lanes:
+        stats[lane.queue_name] = {
+            'weight': lane.weight,
+            'numLeased': lane.num_leased,
+            'backlog': lane.backlog,
+            'waitSecP50': lane.wait_times_sec.Percentile(50),
+            'waitSecP95': lane.wait_times_sec.Percentile(95),
+            'timeTo8bitSecP50': lane.total_times_sec.Percentile(50),
+            'timeTo8bitSecP95': lane.total_times_sec.Percentile(95)
+        }
+      return stats
@@ -0,0 +1,114 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive poll interval and lease sizing used by GCE daemon."""
+
+import math
+import random
+import threading
+
+import settings
+
+
+def BackoffWithJitter(attempt, min_sec, max_sec):
+  """Exponential backoff for the given attempt, with up to 50% jitter."""
+  backoff = min(max_sec, min_sec * 2 ** max(0, attempt - 1))
+  return backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+
+class LeaseController(object):
+  """Tunes poll interval, lease count and lease time from observed results.
+
+  - Empty polls and lease failures back off exponentially from
+    MIN_SLEEP_TIME_NO_TASKS_SEC to MAX_SLEEP_TIME_NO_TASKS_SEC, rate-limit
+    errors from MIN_SLEEP_TIME_RATE_LIMIT_SEC to MAX_SLEEP_TIME_RATE_LIMIT_SEC.
+    A successful lease resets both and polls again immediately.
+  - The lease count doubles while leases come back full (the queue has a
+    backlog) and drops to what was received when they come back short.
+  - The lease time is LEASE_TIME_FACTOR times the moving average of the
+    per-task processing time, kept between LEASE_TIME_SEC and
+    MAX_LEASE_TIME_SEC.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.poll_interval_sec = 0
+    self.lease_count = settings.NUM_TASKS_TO_LEASE
+    self.lease_time_sec = settings.LEASE_TIME_SEC
+    self.avg_task_time_sec = None
+    self.num_empty_polls = 0
+    self.num_rate_limits = 0
+
+  def RecordLease(self, num_requested, num_leased):
+    """Updates the controller after a lease call that did not fail."""
+    with self.lock:
+      self.num_rate_limits = 0
+      if num_leased:
+        self.num_empty_polls = 0
+        self.poll_interval_sec = 0
+        if num_leased >= num_requested:
+          self.lease_count = min(settings.MAX_TASKS_TO_LEASE,
+                                 self.lease_count * 2)
+        else:
+          self.lease_count = max(1, num_leased)
+      else:
+        self.num_empty_polls += 1
+        self.poll_interval_sec = BackoffWithJitter(
+            self.num_empty_polls,
+            settings.MIN_SLEEP_TIME_NO_TASKS_SEC,
+            settings.MAX_SLEEP_TIME_NO_TASKS_SEC)
+
+  def RecordFailure(self):
+    """Backs off after a lease call failed for reasons other than quota."""
+    with self.lock:
+      self.num_empty_polls += 1
+      self.poll_interval_sec = BackoffWithJitter(
+          self.num_empty_polls,
+          settings.MIN_SLEEP_TIME_NO_TASKS_SEC,
+          settings.MAX_SLEEP_TIME_NO_TASKS_SEC)
+
+  def RecordRateLimit(self):
+    """Backs off after the taskqueue API returned a rate-limit error."""
+    with self.lock:
+      self.num_rate_limits += 1
+      self.poll_interval_sec = BackoffWithJitter(
+          self.num_rate_limits,
+          settings.MIN_SLEEP_TIME_RATE_LIMIT_SEC,
+          settings.MAX_SLEEP_TIME_RATE_LIMIT_SEC)
+
+  def RecordTaskTime(self, task_time_sec):
+    """Updates the lease time from the time taken by a finished task."""
+    with self.lock:
+      if self.avg_task_time_sec is None:
+        self.avg_task_time_sec = task_time_sec
+      else:
+        self.avg_task_time_sec += (settings.TASK_TIME_SMOOTHING *
+                                   (task_time_sec - self.avg_task_time_sec))
+      lease_time_sec = int(math.ceil(settings.LEASE_TIME_FACTOR *
+                                     self.avg_task_time_sec))
+      self.lease_time_sec = max(settings.LEASE_TIME_SEC,
+                                min(settings.MAX_LEASE_TIME_SEC,
+                                    lease_time_sec))
+
+  def Stats(self):
+    """Returns the current decisions for the heartbeat statistics."""
+    with self.lock:
+      return {
+          'pollIntervalSec': self.poll_interval_sec,
+          'leaseCount': self.lease_count,
+          'leaseTimeSec': self.lease_time_sec,
+          'avgTaskTimeSec': self.avg_task_time_sec,
+          'numEmptyPolls': self.num_empty_polls,
+          'numRateLimits': self.num_rate_limits
+      }
@@ -0,0 +1,604 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End-to-end load test of the GCE daemon against local stand-in services.
+
+Runs the daemon's lease loop, image worker pool, lease renewer and batchers
+against one local HTTP server standing in for the taskqueue REST API, the
+image host, Cloud Storage and the GAE app's /update/batch endpoint, while
+tasks are added to the lane queues at a steady rate. Each stand-in service
+can be slowed down or made to fail, and leases can be refused with 403 rate
+limit errors:
+
+  python load_test.py --rate 4 --duration 120 --latency storage=0.2 \\
+      --error-rate taskqueue=0.05 --rate-limit-rate 0.1
+
+Reports sustained tasks/min, the latency from adding a task to the app
+receiving its update, and how often a task was processed more than once, as
+happens after a lost lease. The result cache is off unless --result-cache is
+given, so every task goes through the whole pipeline.
+"""
+import argparse
+import base64
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from collections import OrderedDict
+from email.parser import FeedParser
+import hashlib
+import json
+import os
+import random
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import sys
+import threading
+from time import sleep
+from time import time
+import urllib
+import urlparse
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat
+
+from benchmark import GenerateImage
+from profiling import Percentile
+import settings
+
+PROJECT_ID = 'loadtest'
+PROCESSED_IMG_BUCKET = 'loadtest-processed'
+# Stand-in services that latency and errors can be injected into.
+SERVICES = ('taskqueue', 'image', 'storage', 'app')
+TASK_API_PATH = '/taskqueue/v1beta2/projects/'
+BATCH_BOUNDARY = 'batch_load_test'
+LATENCY_PERCENTILES = (50, 90, 95, 99, 100)
+
+
+def Microseconds(epoch_time):
+  """Returns an epoch time as the taskqueue API reports it."""
+  return str(int(epoch_time * 1e6))
+
+
+def JsonResponse(value, status=200, reason='OK'):
+  return status, reason, {'Content-Type': 'application/json'}, (
+      json.dumps(value))
+
+
+def ErrorResponse(status, reason, error_reason):
+  """Returns an error response in the format of Google APIs."""
+  return JsonResponse({'error': {'code': status, 'message': reason,
+                                 'errors': [{'reason': error_reason,
+                                             'message': reason}]}},
+                      status, reason)
+
+
+def DiscoveryDocument(root_url):
+  """Returns the part of the taskqueue v1beta2 discovery document in use."""
+
+  def Parameters(path_names, **query_types):
+    parameters = dict((name, {'type': 'string', 'required': True,
+                              'location': 'path'}) for name in path_names)
+    for name, parameter_type in query_types.iteritems():
+      parameters[name] = {'type': parameter_type, 'location': 'query'}
+    return parameters
+
+  task_path = '{project}/taskqueues/{taskqueue}/tasks/{task}'
+  task_parameters = ('project', 'taskqueue', 'task')
+  return {
+      'kind': 'discovery#restDescription',
+      'discoveryVersion': 'v1',
+      'id': 'taskqueue:v1beta2',
+      'name': 'taskqueue',
+      'version': 'v1beta2',
+      'protocol': 'rest',
+      'rootUrl': root_url + '/',
+      'servicePath': TASK_API_PATH[1:],
+      'batchPath': 'batch',
+      'parameters': {},
+      'schemas': {
+          'Task': {'id': 'Task', 'type': 'object', 'properties': {
+              'id': {'type': 'string'},
+              'payloadBase64': {'type': 'string'}}},
+          'Tasks': {'id': 'Tasks', 'type': 'object', 'properties': {
+              'items': {'type': 'array', 'items': {'$ref': 'Task'}}}},
+          'TaskQueue': {'id': 'TaskQueue', 'type': 'object'}
+      },
+      'resources': {
+          'taskqueues': {'methods': {'get': {
+              'id': 'taskqueue.taskqueues.get',
+              'path': '{project}/taskqueues/{taskqueue}',
+              'httpMethod': 'GET',
+              'parameters': Parameters(('project', 'taskqueue'),
+                                       getStats='boolean'),
+              'parameterOrder': ['project', 'taskqueue'],
+              'response': {'$ref': 'TaskQueue'}}}},
+          'tasks': {'methods': {
+              'lease': {
+                  'id': 'taskqueue.tasks.lease',
+                  'path': '{project}/taskqueues/{taskqueue}/tasks/lease',
+                  'httpMethod': 'POST',
+                  'parameters': Parameters(('project', 'taskqueue'),
+                                           numTasks='integer',
+                                           leaseSecs='integer'),
+                  'parameterOrder': ['project', 'taskqueue', 'numTasks',
+                                     'leaseSecs'],
+                  'response': {'$ref': 'Tasks'}},
+              'delete': {
+                  'id': 'taskqueue.tasks.delete',
+                  'path': task_path,
+                  'httpMethod': 'DELETE',
+                  'parameters': Parameters(task_parameters),
+                  'parameterOrder': list(task_parameters)},
+              'patch': {
+                  'id': 'taskqueue.tasks.patch',
+                  'path': task_path,
+                  'httpMethod': 'PATCH',
+                  'parameters': Parameters(task_parameters,
+                                           newLeaseSeconds='integer'),
+                  'parameterOrder': list(task_parameters) + [
+                      'newLeaseSeconds'],
+                  'request': {'$ref': 'Task'},
+                  'response': {'$ref': 'Task'}}}}
+      }
+  }
+
+
+class Faults(object):
+  """Latency and errors injected into the responses of one service."""
+
+  def __init__(self):
+    self.latency_sec = 0
+    self.error_rate = 0
+    self.rate_limit_rate = 0
+    self.lock = threading.Lock()
+    self.num_errors = 0
+    self.num_rate_limits = 0
+
+  def Inject(self, can_rate_limit=False):
+    """Waits out the latency, returns an error response to send or None."""
+    if self.latency_sec:
+      sleep(self.latency_sec)
+    if can_rate_limit and random.random() < self.rate_limit_rate:
+      with self.lock:
+        self.num_rate_limits += 1
+      return ErrorResponse(403, 'Rate Limit Exceeded', 'rateLimitExceeded')
+    if random.random() < self.error_rate:
+      with self.lock:
+        self.num_errors += 1
+      return ErrorResponse(503, 'Service Unavailable', 'backendError')
+    return None
+
+  def Stats(self):
+    with self.lock:
+      return {'numErrors': self.num_errors,
+              'numRateLimits': self.num_rate_limits}
+
+
+class TaskQueues(object):
+  """Pull queues kept in memory, leased the way the taskqueue API does.
+
+  Records when each task was added and deleted and how often it was leased.
+  """
+
+  def __init__(self, queue_names):
+    self.lock = threading.Lock()
+    # Queue name -> task id -> task, oldest first.
+    self.queues = dict((name, OrderedDict()) for name in queue_names)
+    # Task id -> (queue name, time added).
+    self.added = {}
+    self.deleted = {}
+    self.lease_counts = {}
+
+  def Add(self, queue_name, task_id, payload):
+    now = time()
+    with self.lock:
+      self.queues[queue_name][task_id] = {
+          'kind': 'taskqueues#task',
+          'id': task_id,
+          'queueName': 'projects/s~%s/taskqueues/%s' % (PROJECT_ID,
+                                                        queue_name),
+          'payloadBase64': base64.b64encode(payload),
+          'enqueueTimestamp': Microseconds(now),
+          'leaseTimestamp': Microseconds(now),
+          'retry_count': 0
+      }
+      self.added[task_id] = (queue_name, now)
+
+  def Lease(self, queue_name, num_tasks, lease_sec):
+    """Leases up to num_tasks tasks whose lease has expired, oldest first."""
+    now = time()
+    tasks = []
+    with self.lock:
+      for task in self.queues[queue_name].itervalues():
+        if len(tasks) >= num_tasks:
+          break
+        if float(task['leaseTimestamp']) / 1e6 <= now:
+          task['leaseTimestamp'] = Microseconds(now + lease_sec)
+          task['retry_count'] += 1
+          self.lease_counts[task['id']] = (
+              self.lease_counts.get(task['id'], 0) + 1)
+          tasks.append(dict(task))
+    return tasks
+
+  def Patch(self, queue_name, task_id, lease_sec):
+    """Extends a task's current lease, returns the task or None if lost."""
+    now = time()
+    with self.lock:
+      task = self.queues[queue_name].get(task_id)
+      if not task or float(task['leaseTimestamp']) / 1e6 <= now:
+        return None
+      task['leaseTimestamp'] = Microseconds(now + lease_sec)
+      return dict(task)
+
+  def Delete(self, queue_name, task_id):
+    with self.lock:
+      if self.queues[queue_name].pop(task_id, None) is None:
+        return False
+      self.deleted[task_id] = time()
+      return True
+
+  def Backlog(self, queue_name):
+    with self.lock:
+      return len(self.queues[queue_name])
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+  """Local HTTP server standing in for every service the daemon talks to."""
+  daemon_threads = True
+
+  def __init__(self, queue_names):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+    self.url = 'http://127.0.0.1:%d' % self.server_port
+    self.task_queues = TaskQueues(queue_names)
+    self.faults = dict((service, Faults()) for service in SERVICES)
+    self.lock = threading.Lock()
+    # Image name -> data, and Cloud Storage object path -> data.
+    self.images = {}
+    self.objects = {}
+    # Task id -> [(time received, status)] of metadata updates sent to the
+    # app.
+    self.updates = {}
+
+  def handle_error(self, request, client_address):  # pylint: disable=g-bad-name
+    # Clients closing connections after error responses, as boto does.
+    pass
+
+  def Dispatch(self, method, url, headers, body):
+    """Returns the (status, reason, headers, content) response to a request."""
+    path = urlparse.urlsplit(url).path
+    if path.startswith('/discovery/'):
+      return JsonResponse(DiscoveryDocument(self.url))
+    elif path == '/batch':
+      return (self.faults['taskqueue'].Inject() or
+              self.Batch(headers.getheader('content-type'), body))
+    elif path.startswith(TASK_API_PATH):
+      return (self.faults['taskqueue'].Inject(path.endswith('/lease')) or
+              self.TaskApi(method, url))
+    elif path.startswith('/images/'):
+      return self.faults['image'].Inject() or self.Image(path)
+    elif path == '/update/batch':
+      return self.faults['app'].Inject() or self.Update(body)
+    return self.faults['storage'].Inject() or self.Storage(method, path, body)
+
+  def TaskApi(self, method, url):
+    """Serves the taskqueue API methods the daemon uses."""
+    parts = urlparse.urlsplit(url)
+    query = dict(urlparse.parse_qsl(parts.query))
+    path = [urllib.unquote(part)
+            for part in parts.path[len(TASK_API_PATH):].split('/')]
+    queue_name = path[2]
+    if queue_name not in self.task_queues.queues:
+      return ErrorResponse(404, 'Not Found', 'notFound')
+
+    if len(path) == 3 and method == 'GET':
+      return JsonResponse({
+          'kind': 'taskqueues#taskqueue',
+          'id': queue_name,
+          'stats': {'totalTasks': self.task_queues.Backlog(queue_name)}})
+    elif path[3:] == ['tasks', 'lease'] and method == 'POST':
+      tasks = self.task_queues.Lease(queue_name, int(query['numTasks']),
+                                     int(query['leaseSecs']))
+      return JsonResponse({'kind': 'taskqueue#tasks', 'items': tasks})
+    elif len(path) == 5 and method == 'PATCH':
+      task = self.task_queues.Patch(queue_name, path[4],
+                                    int(query['newLeaseSeconds']))
+      if not task:
+        return ErrorResponse(400, 'Bad Request', 'invalid')
+      return JsonResponse(task)
+    elif len(path) == 5 and method == 'DELETE':
+      if not self.task_queues.Delete(queue_name, path[4]):
+        return ErrorResponse(404, 'Not Found', 'notFound')
+      return 204, 'No Content', {}, ''
+    return ErrorResponse(400, 'Bad Request', 'invalid')
+
+  def Batch(self, content_type, body):
+    """Serves a multipart/mixed batch of taskqueue API requests."""
+    parser = FeedParser()
+    parser.feed('Content-Type: %s\r\n\r\n' % content_type)
+    parser.feed(body)
+    response = StringIO()
+    for part in parser.close().get_payload():
+      request_line, request = part.get_payload().split('\n', 1)
+      method, url, _ = request_line.split(' ', 2)
+      status, reason, _, content = self.TaskApi(method, url)
+      response.write('--%s\r\n' % BATCH_BOUNDARY)
+      response.write('Content-Type: application/http\r\n')
+      response.write('Content-ID: <response-%s\r\n\r\n' %
+                     part['Content-ID'][1:])
+      response.write('HTTP/1.1 %d %s\r\n' % (status, reason))
+      response.write('Content-Type: application/json\r\n')
+      response.write('Content-Length: %d\r\n\r\n' % len(content))
+      response.write('%s\r\n' % content)
+    response.write('--%s--\r\n' % BATCH_BOUNDARY)
+    return 200, 'OK', {'Content-Type': 'multipart/mixed; boundary=%s' %
+                                       BATCH_BOUNDARY}, response.getvalue()
+
+  def Image(self, path):
+    image_data = self.images.get(path[len('/images/'):])
+    if image_data is None:
+      return 404, 'Not Found', {}, ''
+    return 200, 'OK', {'Content-Type': 'image/jpeg'}, image_data
+
+  def Update(self, body):
+    """Records a batch of metadata updates posted to the GAE app."""
+    now = time()
+    with self.lock:
+      for update in json.loads(body):
+        self.updates.setdefault(update['id'], []).append(
+            (now, update['status']))
+    return JsonResponse({})
+
+  def Storage(self, method, path, body):
+    """Serves Cloud Storage XML API object uploads and downloads."""
+    if method == 'PUT':
+      with self.lock:
+        self.objects[path] = body
+      return 200, 'OK', {'ETag': '"%s"' % hashlib.md5(body).hexdigest()}, ''
+    with self.lock:
+      content = self.objects.get(path)
+    if content is None:
+      return 404, 'Not Found', {'Content-Type': 'application/xml'}, (
+          '<?xml version="1.0" encoding="UTF-8"?>'
+          '<Error><Code>NoSuchKey</Code></Error>')
+    return 200, 'OK', {'ETag': '"%s"' % hashlib.md5(content).hexdigest(),
+                       'Content-Type': 'application/octet-stream'}, content
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  """Passes requests to StandInServer.Dispatch."""
+  protocol_version = 'HTTP/1.1'
+
+  def Handle(self):
+    body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    status, reason, headers, content = self.server.Dispatch(
+        self.command, self.path, self.headers, body)
+    self.send_response(status, reason)
+    for name, value in headers.iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(content)
+
+  do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = Handle
+
+  def log_message(self, *unused_args):
+    pass
+
+
+def GenerateImages(server, count, size):
+  """Adds count distinct JPEG images to the image host, returns their URLs."""
+  urls = []
+  for index in xrange(count):
+    image_file = StringIO()
+    GenerateImage(size, index).save(image_file, 'JPEG')
+    name = 'image%d.jpg' % index
+    server.images[name] = image_file.getvalue()
+    urls.append('%s/images/%s' % (server.url, name))
+  return urls
+
+
+def AddTasks(server, image_urls, rate, duration_sec, bulk_fraction):
+  """Adds tasks to the lanes at rate per second, as the GAE app would.
+
+  A bulk_fraction of the tasks goes to the last lane and the rest to the
+  first. Returns the number of tasks added.
+  """
+  first_lane = settings.TASK_QUEUE_LANES[0][0]
+  last_lane = settings.TASK_QUEUE_LANES[-1][0]
+  num_tasks = int(rate * duration_sec)
+  time_start = time()
+  for index in xrange(num_tasks):
+    delay = time_start + index / rate - time()
+    if delay > 0:
+      sleep(delay)
+    task_id = 'task-%d' % index
+    payload = json.dumps({'key': task_id,
+                          'image_link': image_urls[index % len(image_urls)]})
+    queue_name = last_lane if random.random() < bulk_fraction else first_lane
+    server.task_queues.Add(queue_name, task_id, payload)
+  return num_tasks
+
+
+def WaitForTasks(server, timeout_sec):
+  """Waits until every task was deleted, or timeout_sec went by."""
+  deadline = time() + timeout_sec
+  while time() < deadline:
+    if not any(server.task_queues.Backlog(name)
+               for name in server.task_queues.queues):
+      return True
+    sleep(0.5)
+  return False
+
+
+def LatencySummary(latencies):
+  return dict(('p%d' % percent, Percentile(latencies, percent))
+              for percent in LATENCY_PERCENTILES)
+
+
+def Report(server, daemon, time_start, duration_sec, warmup_sec):
+  """Returns the load test results as a dict."""
+  task_queues = server.task_queues
+  with task_queues.lock:
+    added = dict(task_queues.added)
+    deleted = dict(task_queues.deleted)
+    lease_counts = dict(task_queues.lease_counts)
+  with server.lock:
+    updates = dict((task_id, list(task_updates))
+                   for task_id, task_updates in server.updates.iteritems())
+
+  # Throughput while tasks were being added, after the warmup.
+  window_start = time_start + warmup_sec
+  window_end = time_start + duration_sec
+  num_in_window = len([deleted_time for deleted_time in deleted.itervalues()
+                       if window_start <= deleted_time < window_end])
+
+  # Seconds from adding a task to the app's first update on it.
+  latencies = {}
+  for task_id, task_updates in updates.iteritems():
+    queue_name, added_time = added[task_id]
+    latencies.setdefault(queue_name, []).append(task_updates[0][0] -
+                                                added_time)
+  num_leased_again = len([count for count in lease_counts.itervalues()
+                          if count > 1])
+
+  return {
+      'numTasksAdded': len(added),
+      'numTasksDeleted': len(deleted),
+      'numTasksLeft': len(added) - len(deleted),
+      'numTasksUpdated': len(updates),
+      'numTasksFailed': len([task_updates for task_updates in updates.values()
+                             if not task_updates[-1][1]]),
+      'tasksPerMin': num_in_window * 60.0 / (window_end - window_start),
+      'latencySec': LatencySummary(sum(latencies.values(), [])),
+      'latencySecByLane': dict(
+          (queue_name, LatencySummary(lane_latencies))
+          for queue_name, lane_latencies in latencies.iteritems()),
+      # Tasks leased, and so processed, more than once, e.g. after losing
+      # their lease, and extra updates the app received for a task.
+      'numTasksLeasedAgain': num_leased_again,
+      'duplicateProcessingRate': (float(num_leased_again) / len(lease_counts)
+                                  if lease_counts else None),
+      'numDuplicateUpdates': sum(len(task_updates) - 1
+                                 for task_updates in updates.itervalues()),
+      'faults': dict((service, faults.Stats())
+                     for service, faults in server.faults.iteritems()),
+      'daemon': {
+          'stats': dict(daemon.STATS),
+          'leaseController': daemon.lease_controller.Stats(),
+          'stages': daemon.stage_timings.Stats()
+      }
+  }
+
+
+def ServiceValues(value):
+  """Parses a SERVICE=VALUE command line argument."""
+  service, _, number = value.partition('=')
+  if service not in SERVICES:
+    raise argparse.ArgumentTypeError('unknown service %r, one of %s' % (
+        service, ', '.join(SERVICES)))
+  return service, float(number)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--rate', type=float, default=2,
+                      help='Tasks added per second.')
+  parser.add_argument('--duration', type=float, default=60,
+                      help='Seconds to add tasks for.')
+  parser.add_argument('--warmup', type=float, default=10,
+                      help='Seconds left out of the tasks/min measurement.')
+  parser.add_argument('--drain-timeout', type=float, default=120,
+                      help='Seconds to wait for the last tasks to finish.')
+  parser.add_argument('--bulk-fraction', type=float, default=0.2,
+                      help='Fraction of tasks added to the bulk lane.')
+  parser.add_argument('--images', type=int, default=20,
+                      help='Number of distinct images tasks cycle through.')
+  parser.add_argument('--image-size', default='1024x768',
+                      help='WIDTHxHEIGHT of the images.')
+  parser.add_argument('--latency', type=ServiceValues, action='append',
+                      default=[], metavar='SERVICE=SEC',
+                      help='Seconds added to every response of a service, '
+                      'one of %s.' % ', '.join(SERVICES))
+  parser.add_argument('--error-rate', type=ServiceValues, action='append',
+                      default=[], metavar='SERVICE=RATE',
+                      help='Fraction of requests to a service answered with '
+                      'a 503 error.')
+  parser.add_argument('--rate-limit-rate', type=float, default=0,
+                      help='Fraction of leases answered with a 403 rate '
+                      'limit error.')
+  parser.add_argument('--result-cache', action='store_true',
+                      help='Reuse results for repeated images.')
+  parser.add_argument('--heartbeat-port', type=int, default=9001,
+                      help='Port of the daemon\'s heartbeat server.')
+  parser.add_argument('--log-file', default='load-test.log',
+                      help='Daemon log file.')
+  args = parser.parse_args()
+
+  server = StandInServer([name for name, _ in settings.TASK_QUEUE_LANES])
+  for service, latency_sec in args.latency:
+    server.faults[service].latency_sec = latency_sec
+  for service, error_rate in args.error_rate:
+    server.faults[service].error_rate = error_rate
+  server.faults['taskqueue'].rate_limit_rate = args.rate_limit_rate
+  image_urls = GenerateImages(
+      server, args.images,
+      tuple(int(n) for n in args.image_size.split('x')))
+
+  settings.PROJECT_ID = PROJECT_ID
+  settings.PROCESSED_IMG_BUCKET = PROCESSED_IMG_BUCKET
+  settings.TASK_API_DISCOVERY_URL = (server.url +
+                                     '/discovery/{api}/{apiVersion}/rest')
+  settings.TASK_API_BATCH_URL = server.url + '/batch'
+  settings.APP_URL = server.url
+  settings.HEARTBEAT_PORT = args.heartbeat_port
+  settings.LOG_FILENAME = args.log_file
+  if not args.result_cache:
+    settings.RESULT_CACHE_SIZE = 0
+  # Imported once settings are in place, as the daemon reads some on import.
+  import compute_engine_daemon as daemon  # pylint: disable=g-import-not-at-top
+
+  # Start image worker processes before any other threads are running.
+  daemon.StartImagePool()
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  daemon.ConnectServices(
+      lambda http: http,
+      lambda: boto.connect_gs('load-test', 'load-test',
+                              host='127.0.0.1', port=server.server_port,
+                              is_secure=False,
+                              calling_format=OrdinaryCallingFormat()))
+  daemon.StartDaemonThreads()
+  daemon_thread = threading.Thread(target=daemon.main)
+  daemon_thread.daemon = True
+  daemon_thread.start()
+
+  time_start = time()
+  num_tasks = AddTasks(server, image_urls, args.rate, args.duration,
+                       args.bulk_fraction)
+  print 'Added %d tasks in %.1f seconds, waiting for them to finish.' % (
+      num_tasks, time() - time_start)
+  if not WaitForTasks(server, args.drain_timeout):
+    print 'Tasks still left after %g seconds.' % args.drain_timeout
+  print json.dumps(Report(server, daemon, time_start, args.duration,
+                          args.warmup), indent=2, sort_keys=True)
+  sys.stdout.flush()
+  # Task threads still stuck on a stand-in would keep the process alive.
+  daemon.image_pool.terminate()
+  os._exit(0)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+  main()
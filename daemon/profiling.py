@@ -0,0 +1,203 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pipeline stage timing and sampled profiling used by GCE daemon."""
+
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import glob
+import math
+import os
+import pstats
+import random
+from StringIO import StringIO
+import threading
+from time import time
+
+import settings
+
+# Percentiles reported for every histogram.
+PERCENTILES = (50, 95, 99)
+
+
+def Percentile(values, percent):
+  """Returns the given percentile of a list of numbers, or None if empty."""
+  if not values:
+    return None
+  values = sorted(values)
+  return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+class Histogram(object):
+  """Rolling window of the last size samples, plus all-time count and sum.
+
+  Not thread-safe; callers hold their own lock.
+  """
+
+  def __init__(self, size):
+    self.samples = deque(maxlen=size)
+    self.count = 0
+    self.sum = 0.0
+
+  def Add(self, value):
+    self.samples.append(value)
+    self.count += 1
+    self.sum += value
+
+  def Percentile(self, percent):
+    return Percentile(self.samples, percent)
+
+  def Summary(self):
+    summary = {'count': self.count, 'sum': self.sum}
+    values = sorted(self.samples)
+    for percent in PERCENTILES:
+      summary['p%d' % percent] = Percentile(values, percent)
+    return summary
+
+
+class StageClock(object):
+  """Times consecutive pipeline stages within one task.
+
+  Each Mark(stage) charges the time since the previous mark to that stage.
+  """
+
+  def __init__(self):
+    self.timings = {}
+    self.last_mark = time()
+
+  def Mark(self, stage):
+    now = time()
+    self.timings[stage] = self.timings.get(stage, 0) + now - self.last_mark
+    self.last_mark = now
+
+
+class NullClock(object):
+  """StageClock stand-in for callers that do not time stages."""
+
+  def Mark(self, stage):
+    pass
+
+
+NULL_CLOCK = NullClock()
+
+
+class StageTimings(object):
+  """Thread-safe rolling histograms of seconds spent per pipeline stage."""
+
+  def __init__(self, size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.histograms = {}
+
+  def Record(self, stage, seconds):
+    with self.lock:
+      if stage not in self.histograms:
+        self.histograms[stage] = Histogram(self.size)
+      self.histograms[stage].Add(seconds)
+
+  def RecordAll(self, timings):
+    """Records a dict of stage -> seconds, such as StageClock.timings."""
+    for stage, seconds in timings.iteritems():
+      self.Record(stage, seconds)
+
+  @contextmanager
+  def Time(self, stage):
+    """Records the time taken by the enclosed block under stage."""
+    start = time()
+    try:
+      yield
+    finally:
+      self.Record(stage, time() - start)
+
+  def Stats(self):
+    """Returns {stage: {count, sum, p50, p95, p99}} for the heartbeat."""
+    with self.lock:
+      return dict((stage, histogram.Summary())
+                  for stage, histogram in self.histograms.iteritems())
+
+  def PrometheusText(self, name):
+    """Returns the histograms as a Prometheus text format summary."""
+    lines = ['# TYPE %s summary' % name]
+    for stage, summary in sorted(self.Stats().iteritems()):
+      for percent in PERCENTILES:
+        value = summary['p%d' % percent]
+        if value is not None:
+          lines.append('%s{stage="%s",quantile="%g"} %g' % (
+              name, stage, percent / 100.0, value))
+      lines.append('%s_sum{stage="%s"} %g' % (name, stage, summary['sum']))
+      lines.append('%s_count{stage="%s"} %d' % (name, stage,
+                                                summary['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def ShouldProfile():
+  """Returns whether to profile the next task, per PROFILE_SAMPLE_RATE."""
+  return random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+def RunProfiled(name, function, *args):
+  """Runs function under cProfile, saving stats to PROFILE_DIR.
+
+  Each run is saved as its own file named after name, the process id and the
+  time, so the daemon and its worker processes can all write there.
+  """
+  profile = cProfile.Profile()
+  try:
+    return profile.runcall(function, *args)
+  finally:
+    if not os.path.isdir(settings.PROFILE_DIR):
+      try:
+        os.makedirs(settings.PROFILE_DIR)
+      except OSError:
+        # Created by another process meanwhile.
+        pass
+    profile.dump_stats(os.path.join(
+        settings.PROFILE_DIR,
+        '%s-%d-%f.prof' % (name, os.getpid(), time())))
+    PruneProfiles()
+
+
+def ProfileFilenames():
+  """Returns the names of the profiles saved in PROFILE_DIR."""
+  return glob.glob(os.path.join(settings.PROFILE_DIR, '*.prof'))
+
+
+def PruneProfiles():
+  """Removes the oldest saved profiles beyond PROFILE_MAX_FILES."""
+  filenames = []
+  for filename in ProfileFilenames():
+    try:
+      filenames.append((os.path.getmtime(filename), filename))
+    except OSError:
+      # Removed by another process meanwhile.
+      pass
+  filenames.sort()
+  excess = max(len(filenames) - settings.PROFILE_MAX_FILES, 0)
+  for _, filename in filenames[:excess]:
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
+
+
+def ProfileReport(num_functions=40):
+  """Returns the saved profiles combined, by cumulative time, as text."""
+  filenames = ProfileFilenames()
+  if not filenames:
+    return 'No profiles in %s.\n' % settings.PROFILE_DIR
+  output = StringIO()
+  stats = pstats.Stats(*filenames, stream=output)
+  stats.sort_stats('cumulative').print_stats(num_functions)
+  return output.getvalue()
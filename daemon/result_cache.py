@@ -0,0 +1,131 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of processed images used by GCE daemon."""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+
+import settings
+
+# Settings that change the processed image. Part of every cache key, along
+# with the quotes images are captioned with, so a settings or quotes change
+# never reuses results produced with the old values.
+PROCESSING_SETTINGS = ('BIT_DEPTH', 'THUMBNAIL_WIDTH', 'FINAL_WIDTH',
+                       'FAST_PATH', 'FAST_PATH_WORKING_WIDTH',
+                       'BORDER_EDGE_SIZE_PIXELS', 'BORDER_COLOR',
+                       'FONT_TTF', 'FONT_SIZE', 'QUOTE_TEXT_COLOR',
+                       'QUOTE_BG_COLOR')
+
+
+def ResultCacheKey(content_hash, quotes):
+  """Returns the cache key for an image's content hash and current settings.
+
+  quotes are the quotes a processed image may be captioned with.
+  """
+  key = hashlib.sha1(content_hash)
+  for name in PROCESSING_SETTINGS:
+    key.update('\0%s=%r' % (name, getattr(settings, name)))
+  for quote in quotes:
+    key.update('\0quote=%r' % quote)
+  return key.hexdigest()
+
+
+class LocalCacheTier(object):
+  """Thread-safe in-memory LRU cache holding at most max_size entries."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+
+  def Get(self, key):
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is not None:
+        # Re-insert as most recently used.
+        self.entries[key] = value
+      return value
+
+  def Set(self, key, value):
+    if not self.max_size:
+      return
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+
+class ResultCache(object):
+  """Two-tier cache from result cache key to processed object name.
+
+  Lookups go to the local tier first, then to the optional shared tier. The
+  shared tier is any object with Get(key) and Set(key, value) methods, for
+  sharing results between daemons; errors from it are logged and treated as
+  misses.
+  """
+
+  def __init__(self, local_tier, shared_tier=None):
+    self.local_tier = local_tier
+    self.shared_tier = shared_tier
+    self.lock = threading.Lock()
+    self.num_local_hits = 0
+    self.num_shared_hits = 0
+    self.num_misses = 0
+
+  def Get(self, key):
+    """Returns the processed object name cached for key, or None."""
+    value = self.local_tier.Get(key)
+    if value is not None:
+      with self.lock:
+        self.num_local_hits += 1
+      return value
+
+    if self.shared_tier:
+      try:
+        value = self.shared_tier.Get(key)
+      except Exception, e:
+        logging.error('Error reading shared result cache: %s', e)
+      if value is not None:
+        self.local_tier.Set(key, value)
+        with self.lock:
+          self.num_shared_hits += 1
+        return value
+
+    with self.lock:
+      self.num_misses += 1
+    return None
+
+  def Set(self, key, value):
+    """Caches the processed object name for key in every tier."""
+    self.local_tier.Set(key, value)
+    if self.shared_tier:
+      try:
+        self.shared_tier.Set(key, value)
+      except Exception, e:
+        logging.error('Error writing shared result cache: %s', e)
+
+  def Stats(self):
+    with self.lock:
+      num_lookups = self.num_local_hits + self.num_shared_hits + self.num_misses
+      num_hits = self.num_local_hits + self.num_shared_hits
+      return {
+          'numLocalHits': self.num_local_hits,
+          'numSharedHits': self.num_shared_hits,
+          'numMisses': self.num_misses,
+          'hitRate': float(num_hits) / num_lookups if num_lookups else None
+      }
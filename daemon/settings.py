@@ -15,7 +15,6 @@
 """GCE configuration settings file."""
 
 PROJECT_ID = '[PROJECT_ID]'
-QUEUE_NAME = 'imagetasks'
 
 GOOGLE_STORAGE = 'gs'
 # Do not include the "gs://" prefix to the bucket name.
@@ -32,22 +31,85 @@ PRIVATE_KEY_LOCATION = '[SERVICE_ACCOUNT_PRIVATE_KEY]'
 QUOTES_FILE_LOCATION = 'quotes.txt'
 
 ## Task Queue Config options
-# Number of tasks to lease in one cycle.
+# Priority lanes: pull queues to lease tasks from, with their weights. Under
+# contention each queue gets leased tasks in proportion to its weight, and
+# the share of an idle queue goes to the others. Must match the queues in
+# the GAE app's queue.yaml.
+TASK_QUEUE_LANES = [('imagetasks', 4), ('imagetasks-bulk', 1)]
+# Seconds before a queue that came back empty is polled again, as long as
+# other queues still have tasks.
+EMPTY_LANE_POLL_INTERVAL_SEC = 0.5
+# Seconds between fetches of each queue's backlog, as reported by the
+# heartbeat server. Each fetch is one taskqueue API call per queue.
+LANE_BACKLOG_INTERVAL_SEC = 60
+# Number of tasks to lease in the first cycle. The lease count then adapts
+# to the queue backlog, up to MAX_TASKS_TO_LEASE.
 NUM_TASKS_TO_LEASE = 5
-# Amount of time to lease a task for in seconds.
+MAX_TASKS_TO_LEASE = 50
+# Minimum amount of time to lease a task for in seconds. The lease time is
+# LEASE_TIME_FACTOR times the average time taken per task, up to
+# MAX_LEASE_TIME_SEC.
 LEASE_TIME_SEC = 5
+MAX_LEASE_TIME_SEC = 300
+LEASE_TIME_FACTOR = 3
+# Leases on tasks still being worked on are renewed when they are within
+# LEASE_RENEWAL_MARGIN_SEC of expiring, checked every
+# LEASE_RENEWAL_INTERVAL_SEC.
+LEASE_RENEWAL_INTERVAL_SEC = 1
+LEASE_RENEWAL_MARGIN_SEC = 2
+# Finished tasks are deleted in batches of up to DELETE_BATCH_MAX_SIZE, sent
+# at most DELETE_BATCH_WINDOW_SEC after the first task of the batch finished.
+DELETE_BATCH_MAX_SIZE = 50
+DELETE_BATCH_WINDOW_SEC = 0.5
+# Weight given to each new task time in the moving average (0 to 1).
+TASK_TIME_SMOOTHING = 0.2
+# Maximum number of leased tasks being worked on at once. New tasks are
+# leased as soon as any task's image is uploaded and the count drops below
+# this; metadata updates and deletes then complete without holding a slot.
+# None uses twice the image worker pool size.
+MAX_TASKS_IN_FLIGHT = None
+# Taskqueue API discovery document and batch request endpoint. Only changed
+# to run against stand-in services, as load_test.py does.
+TASK_API_DISCOVERY_URL = ('https://www.googleapis.com/discovery/v1/apis/'
+                          '{api}/{apiVersion}/rest')
+TASK_API_BATCH_URL = 'https://www.googleapis.com/batch'
 
-# Amount of time for daemon to sleep after having...
-# - successfully chomped a task.
-SLEEP_TIME_AFTER_TASKS_SEC = 1
-# - found task queue empty.
-SLEEP_TIME_AFTER_NO_TASKS_SEC = 4
+# Range of time for daemon to sleep, backing off exponentially with jitter,
+# after having...
+# - found task queue empty, or failed to lease tasks.
+MIN_SLEEP_TIME_NO_TASKS_SEC = 0.5
+MAX_SLEEP_TIME_NO_TASKS_SEC = 30
 # - been rate limitted.
-SLEEP_TIME_RATE_LIMIT = 10
+MIN_SLEEP_TIME_RATE_LIMIT_SEC = 10
+MAX_SLEEP_TIME_RATE_LIMIT_SEC = 120
 
 # Task queue reader Log filename
 LOG_FILENAME = 'task-queue-reader.log'
 
+## Image worker pool options
+# Number of long-lived worker processes used for image processing.
+# None uses one process per CPU core.
+IMAGE_POOL_SIZE = None
+# Maximum number of images handed to the pool at once, running or waiting.
+# None uses twice the pool size.
+IMAGE_POOL_QUEUE_DEPTH = None
+# Seconds to wait for a worker to process a single image before giving up.
+IMAGE_POOL_TIMEOUT_SEC = 300
+
+# Downloaded images larger than this many bytes are spilled to a temporary
+# file rather than held in memory. None keeps every image in memory.
+IMAGE_SPILL_THRESHOLD_BYTES = 32 * 1024 * 1024
+
+## Result cache options
+# Uploads with the same content as an earlier one, under the same processing
+# settings, reuse its processed image instead of being processed again.
+# Number of results remembered in memory by each daemon.
+RESULT_CACHE_SIZE = 10000
+# Share results between daemons through small objects named
+# RESULT_CACHE_PREFIX + <hash> in PROCESSED_IMG_BUCKET.
+RESULT_CACHE_SHARED = False
+RESULT_CACHE_PREFIX = 'result-cache/'
+
 ## Image processing options
 # Number of colors (bit-depth) for PIL image quantization.
 BIT_DEPTH = 8
@@ -56,6 +118,12 @@ BIT_DEPTH = 8
 THUMBNAIL_WIDTH = 64
 # Defines the maximum width of the resulting processed image.
 FINAL_WIDTH = 768
+# Fast path: shrink the image to FAST_PATH_WORKING_WIDTH before quantizing,
+# blurring and adding the border, rather than working at full resolution.
+# Output differs slightly from the full pipeline; use compare_pipelines.py to
+# measure the difference on sample images before enabling.
+FAST_PATH = False
+FAST_PATH_WORKING_WIDTH = 256
 
 # True-Type Font file location used for quotes in processed images.
 # To install FreeSans: sudo apt-get install fonts-freefont-ttf'
@@ -71,6 +139,35 @@ QUOTE_BG_COLOR = '#000'
 BORDER_EDGE_SIZE_PIXELS = 10
 BORDER_COLOR = '#EEE'
 
+## GAE app update options
+# Base URL of the GAE app that metadata updates are posted to.
+APP_URL = 'https://%s.appspot.com' % PROJECT_ID
+# Metadata updates for finished tasks are posted to the app in batches of up
+# to UPDATE_BATCH_MAX_SIZE, sent at most UPDATE_BATCH_WINDOW_SEC after the
+# first update of the batch finished.
+UPDATE_BATCH_MAX_SIZE = 20
+UPDATE_BATCH_WINDOW_SEC = 0.5
+
+## Outbound connection options
+# Maximum number of kept-alive connections to each host (taskqueue API, image
+# server, GAE app and Cloud Storage).
+MAX_CONNECTIONS_PER_HOST = 10
+# Socket timeout for outbound requests in seconds.
+HTTP_TIMEOUT_SEC = 60
+
+## Profiling options
+# Number of recent samples per pipeline stage (download, decode, quantize,
+# upload, ...) kept for the latency percentiles reported by the heartbeat
+# server, as JSON and, under /metrics, in Prometheus text format.
+STAGE_HISTOGRAM_SIZE = 1000
+# Fraction of tasks (0 to 1) run under cProfile, in the daemon and in the
+# image worker process. Each profile is saved to PROFILE_DIR, keeping only
+# the newest PROFILE_MAX_FILES; /profile on the heartbeat server reports them
+# combined. 0 disables profiling.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = '/tmp/smashpix-profiles'
+PROFILE_MAX_FILES = 100
+
 ## Heartbeat statistics web server information.
 HEARTBEAT_ADDRESS = ''
 HEARTBEAT_PORT = 9000
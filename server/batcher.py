@@ -0,0 +1,75 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of concurrent requests' work into shared batches."""
+
+import threading
+
+
+class Batch(object):
+  """Items coalesced into one send_batch call, and its outcome."""
+
+  def __init__(self):
+    self.items = []
+    self.full = threading.Event()
+    self.done = threading.Event()
+    self.results = None
+    self.error = None
+
+
+class RequestBatcher(object):
+  """Coalesces items from concurrent request threads into batched calls.
+
+  App Engine requests cannot rely on background threads, so the thread that
+  opens a batch sends it: it waits up to window_sec for other requests to
+  join, or until max_size items are waiting, then calls send_batch with the
+  list of items. send_batch returns one result per item; if it raises, every
+  request in the batch gets the error.
+  """
+
+  def __init__(self, send_batch, max_size, window_sec):
+    self.send_batch = send_batch
+    self.max_size = max_size
+    self.window_sec = window_sec
+    self.lock = threading.Lock()
+    self.open_batch = None
+
+  def Send(self, item):
+    """Adds an item to a batch and returns its result once sent."""
+    with self.lock:
+      if not self.open_batch:
+        self.open_batch = Batch()
+      batch = self.open_batch
+      batch.items.append(item)
+      index = len(batch.items) - 1
+      if len(batch.items) >= self.max_size:
+        self.open_batch = None
+        batch.full.set()
+
+    if index == 0:
+      batch.full.wait(self.window_sec)
+      with self.lock:
+        if self.open_batch is batch:
+          self.open_batch = None
+      try:
+        batch.results = self.send_batch(batch.items)
+      except Exception, e:  # pylint: disable=broad-except
+        batch.error = e
+      batch.done.set()
+    else:
+      batch.done.wait()
+
+    if batch.error:
+      raise batch.error
+    return batch.results[index]
@@ -13,24 +13,30 @@
 # limitations under the License.
 
 """Cloud Orchestration GAE App."""
-from cStringIO import StringIO
 from datetime import datetime
+import hashlib
 import json
 import logging
 import os
+from Queue import Empty
+from Queue import Queue
+import threading
+import urllib
 
 import jinja2
-from PIL import Image
 import webapp2
 import yaml
 
+from batcher import RequestBatcher
 import cloudstorage as gcs
 from models import Bitdoc
+from models import BitdocSummary
+import serving_urls
 
 from google.appengine.api import images
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
-from google.appengine.ext import blobstore
 from google.appengine.ext import db
 
 
@@ -44,9 +50,40 @@ config = yaml.load(open('settings.cfg', 'r'))
 MAIN_BUCKET = config['GCS']['MAIN_BUCKET']
 BIT_BUCKET = config['GCS']['BIT_BUCKET']
 TASKQUEUE = 'imagetasks'
+# Priority lane for bulk uploads, leased from at a lower weight by GCE.
+# Objects uploaded with the metadata "x-goog-meta-priority: bulk" go there.
+BULK_TASKQUEUE = 'imagetasks-bulk'
+BULK_PRIORITY = 'bulk'
 
-# Get Task Queue.
+# Get Task Queues.
 processing_task_queue = taskqueue.Queue(TASKQUEUE)
+bulk_processing_task_queue = taskqueue.Queue(BULK_TASKQUEUE)
+
+# Front page listing: Bitdocs per page and seconds a page stays in memcache.
+# Cached pages are keyed by a generation number which every Bitdoc write
+# increments, so writes invalidate all of them at once.
+FRONT_PAGE_SIZE = 20
+FRONT_PAGE_CACHE_TIME_SEC = 60
+FRONT_PAGE_GENERATION_KEY = 'front_page_generation'
+
+# Number of Bitdocs given a BitdocSummary per backfill task.
+BACKFILL_BATCH_SIZE = 100
+
+# Uploaded files are copied to Cloud Storage in chunks of this many bytes, by
+# up to UPLOAD_CONCURRENCY threads at once.
+UPLOAD_CHUNK_SIZE_BYTES = 256 * 1024
+UPLOAD_CONCURRENCY = 5
+
+# Bitdocs from notifications arriving within OCN_BATCH_WINDOW_SEC of each
+# other are written with their processing tasks in one transaction. A
+# transaction can enqueue at most 5 tasks.
+OCN_BATCH_MAX_SIZE = 5
+OCN_BATCH_WINDOW_SEC = 0.05
+
+# Leading bytes identifying each accepted image format.
+IMAGE_SIGNATURES = (('\xff\xd8\xff', 'image/jpeg'),
+                    ('\x89PNG\r\n\x1a\n', 'image/png'))
+IMAGE_SIGNATURE_SIZE = max(len(signature) for signature, _ in IMAGE_SIGNATURES)
 
 
 #############
@@ -61,25 +98,192 @@ def GetGreeting(user, request):
             'Please log in.</a>' % users.create_login_url(request.uri))
 
 
+def GetImageLinksFromBucket(bucket_name, object_names):
+  """Returns a dict from object name to image link, looked up in parallel."""
+  gcs_image_locations = dict((object_name,
+                              '/gs/%s/%s' % (bucket_name, object_name))
+                             for object_name in object_names)
+  logging.info('Trying to get image links for %s',
+               gcs_image_locations.values())
+  lookups = serving_urls.GetServingUrlsAsync(gcs_image_locations.values())
+
+  # Try to get public image URLs for entry creation.
+  image_links = {}
+  for object_name, gcs_image_location in gcs_image_locations.iteritems():
+    try:
+      image_link = lookups[gcs_image_location].get_result()
+      logging.info('Image link: %s', image_link)
+    except images.ObjectNotFoundError:
+      logging.error('Could not find image link for %s.',
+                    gcs_image_location)
+      image_link = ('http://commondatastorage.googleapis.com/'
+                    '8bit-images%2Fnoimage.gif')
+    except Exception, e:
+      logging.error('Exception getting image link from bucket: %s', e)
+      image_link = ('http://commondatastorage.googleapis.com/8bit-images'
+                    '%2Fbucket_missing_image.png')
+    image_links[object_name] = image_link
+  return image_links
+
+
 def GetImageLinkFromBucket(bucket_name, object_name):
-  # Get Image location in GCS.
-  gcs_image_location = '/gs/%s/%s' % (bucket_name, object_name)
-  logging.info('Trying to get image link for "%s"', gcs_image_location)
-  blob_key = blobstore.create_gs_key(gcs_image_location)
+  return GetImageLinksFromBucket(bucket_name, [object_name])[object_name]
+
+
+def GetImageContentType(header):
+  """Returns the content type for an image's leading bytes, or None."""
+  for signature, content_type in IMAGE_SIGNATURES:
+    if header.startswith(signature):
+      return content_type
+  return None
+
+
+def StreamFileToGcs(source, filename, content_type, owner):
+  """Copies a file object to a new Cloud Storage file in chunks."""
+  gcs_file = gcs.open(filename,
+                      'w',
+                      content_type=content_type,
+                      options={'x-goog-meta-owner': owner})
+  while True:
+    chunk = source.read(UPLOAD_CHUNK_SIZE_BYTES)
+    if not chunk:
+      break
+    gcs_file.write(chunk)
+  # Only finalized, and so only notified to /ocn, once fully written.
+  gcs_file.close()
+
+
+def UploadFilesToGcs(uploads, owner):
+  """Streams (source, filename, content type) uploads to Cloud Storage.
+
+  Up to UPLOAD_CONCURRENCY files are written at once. Returns the filenames
+  that failed to upload.
+  """
+  pending = Queue()
+  for upload in uploads:
+    pending.put(upload)
+  failed = []
+
+  def UploadWorker():
+    while True:
+      try:
+        source, filename, content_type = pending.get_nowait()
+      except Empty:
+        return
+      try:
+        StreamFileToGcs(source, filename, content_type, owner)
+        logging.info('Uploaded file %s in the cloud.', filename)
+      except Exception, e:  # pylint: disable=broad-except
+        logging.error('Error uploading file %s: %s', filename, e)
+        failed.append(filename)
+
+  workers = [threading.Thread(target=UploadWorker)
+             for _ in xrange(min(UPLOAD_CONCURRENCY, len(uploads)))]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return failed
+
+
+def SetBitifiedImageLink(bitdoc, image_8bit_link):
+  """Sets the 8-bit image link and timestamp on a Bitdoc from GCE results.
+
+  A missing image_8bit_link means GCE failed to process the image.
+  """
+  if image_8bit_link:
+    bitdoc.image_8bit_link = image_8bit_link
+  else:
+    bitdoc.image_8bit_link = ('http://commondatastorage.googleapis.com/'
+                              '8bit-images%2Fbucket_missing_image.png')
+  bitdoc.timestamp_8bit = datetime.now()
+
+
+def GetFrontPageListing(cursor=None):
+  """Returns a page of BitdocSummaries, newest first, and the next cursor."""
+  generation = memcache.get(FRONT_PAGE_GENERATION_KEY) or 0
+  cache_key = 'front_page:%s:%s' % (generation,
+                                    hashlib.md5(cursor or '').hexdigest())
+  listing = memcache.get(cache_key)
+  if listing is not None:
+    return listing
 
-  # Try to get public image URL for entry creation.
+  query = BitdocSummary.all().order('-timestamp')
   try:
-    image_link = images.get_serving_url(blob_key, secure_url=True)
-    logging.info('Image link: %s', image_link)
-    return image_link
-  except images.ObjectNotFoundError:
-    logging.error('Could not find image link for %s.',
-                  gcs_image_location)
-    return 'http://commondatastorage.googleapis.com/8bit-images%2Fnoimage.gif'
-  except Exception, e:
-    logging.error('Exception getting image link from bucket: %s', e)
-    return ('http://commondatastorage.googleapis.com/8bit-images'
-            '%2Fbucket_missing_image.png')
+    if cursor:
+      query.with_cursor(cursor)
+    bitdocs = query.fetch(FRONT_PAGE_SIZE)
+  except (db.BadValueError, db.BadRequestError), e:
+    if not cursor:
+      raise
+    logging.error('Invalid front page cursor "%s": %s', cursor, e)
+    return GetFrontPageListing()
+  next_cursor = None
+  if len(bitdocs) == FRONT_PAGE_SIZE:
+    next_cursor = query.cursor()
+
+  listing = (bitdocs, next_cursor)
+  memcache.set(cache_key, listing, time=FRONT_PAGE_CACHE_TIME_SEC)
+  return listing
+
+
+def IsNewGeneration(generation, stored_bitdoc):
+  """Returns whether an object generation is newer than a stored Bitdoc's."""
+  return not stored_bitdoc or generation > (stored_bitdoc.generation or 0)
+
+
+def CreateBitdocsWithTasks(bitdocs_and_tasks):
+  """Writes (Bitdoc, task payload, queue) items and summaries atomically.
+
+  Either all Bitdocs are stored and all their processing tasks enqueued, or
+  nothing is, so a failure never leaves a Bitdoc without a task. Bitdocs
+  already stored for the same object generation are skipped. Returns whether
+  each Bitdoc was written.
+  """
+  def Transaction():
+    stored_bitdocs = dict(
+        (str(stored_bitdoc.key()), stored_bitdoc) for stored_bitdoc in
+        db.get([bitdoc.key() for bitdoc, _, _ in bitdocs_and_tasks])
+        if stored_bitdoc)
+    entities = []
+    # Queue name -> (queue, tasks to add to it).
+    tasks = {}
+    written = []
+    for bitdoc, payload, queue in bitdocs_and_tasks:
+      key = str(bitdoc.key())
+      is_new = IsNewGeneration(bitdoc.generation, stored_bitdocs.get(key))
+      if is_new:
+        # Also catches duplicates within this batch.
+        stored_bitdocs[key] = bitdoc
+        entities.extend([bitdoc, BitdocSummary.FromBitdoc(bitdoc)])
+        # A fresh task on each attempt, as a retried transaction cannot add
+        # tasks already added by the failed one.
+        task = taskqueue.Task(payload=payload, method='PULL')
+        tasks.setdefault(queue.name, (queue, []))[1].append(task)
+      written.append(is_new)
+    if entities:
+      db.put(entities)
+      for queue, queue_tasks in tasks.itervalues():
+        queue.add(queue_tasks, transactional=True)
+    return written
+
+  # Each Bitdoc and each summary is its own entity group.
+  written = db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), Transaction)
+  if any(written):
+    InvalidateFrontPageListing()
+  return written
+
+
+ocn_batcher = RequestBatcher(CreateBitdocsWithTasks,
+                             OCN_BATCH_MAX_SIZE,
+                             OCN_BATCH_WINDOW_SEC)
+
+
+def InvalidateFrontPageListing():
+  """Drops all cached front pages after Bitdocs were written or deleted."""
+  # Not waited on; App Engine completes the RPC before the request ends.
+  memcache.Client().incr_async(FRONT_PAGE_GENERATION_KEY, initial_value=0)
 
 
 #############
@@ -93,14 +297,16 @@ class MainPage(webapp2.RequestHandler):
 
     greeting = GetGreeting(user, self.request)
 
-    bitdocs = []
-    bitdocs = db.GqlQuery('SELECT * FROM Bitdoc ORDER BY timestamp '
-                          'DESC LIMIT 100')
+    bitdocs, next_cursor = GetFrontPageListing(self.request.get('cursor'))
+    next_page_url = None
+    if next_cursor:
+      next_page_url = '/?%s' % urllib.urlencode({'cursor': next_cursor})
 
     template = jinja_environment.get_template('index.html')
     template_data = {
         'greeting': greeting,
-        'bitdocs': bitdocs
+        'bitdocs': bitdocs,
+        'next_page_url': next_page_url
     }
 
     self.response.write(template.render(template_data))
@@ -111,6 +317,10 @@ class UploadPage(webapp2.RequestHandler):
 
   def get(self):  # pylint: disable=g-bad-name
     """Returns basic upload form."""
+    self.WriteUploadForm()
+
+  def WriteUploadForm(self, failed_files=None):
+    """Writes the upload form, listing files that failed to upload if any."""
     user = users.get_current_user()
     greeting = GetGreeting(user, self.request)
     upload_url = '/upload'
@@ -118,59 +328,62 @@ class UploadPage(webapp2.RequestHandler):
     template = jinja_environment.get_template('upload.html')
     template_data = {
         'greeting': greeting,
-        'upload_url': upload_url
+        'upload_url': upload_url,
+        'failed_files': failed_files
     }
     self.response.write(template.render(template_data))
 
   def post(self):  # pylint: disable=g-bad-name
-    """Handles image upload form post."""
-    file_img = self.request.get('file')
-    if not file_img:
+    """Handles image upload form posts of one or more files.
+
+    Each file's format is detected from its leading bytes and the file is
+    streamed to Cloud Storage without decoding or copying it.
+    """
+    fields = [field for field in self.request.POST.getall('file')
+              if hasattr(field, 'file')]
+    if not fields:
       logging.error('No image uploaded.')
       self.error(400)
+      return
 
-    img_str = StringIO(file_img)
-    contents = img_str.getvalue()
-    try:
-      img = Image.open(img_str)
-    except IOError, e:
-      logging.error('%s', e)
-      self.error(404)
-
-    logging.info('FORMAT: %s', img.format)
-    if img.format == 'JPEG':
-      content_type = 'image/jpeg'
-    elif img.format == 'PNG':
-      content_type = 'image/png'
-    else:
-      logging.error('Unknown format: %s', img.format)
-      content_type = 'text/plain'
-
-    image_name = self.request.params['file'].filename
-    logging.info('Uploading file "%s"...', image_name)
-    if image_name.find('.'):
-      image_name = image_name[:image_name.find('.')]
-
-    filename = '/%s/%s_%s' % (MAIN_BUCKET,
-                              image_name,
-                              datetime.strftime(datetime.now(),
-                                                '%Y_%M_%d_%H_%M_%S_%s'))
     user = users.get_current_user()
     if user:
       owner = user.nickname()
     else:
       owner = 'Anonymous'
 
-    # Create new image file
-    gcs_file = gcs.open(filename,
-                        'w',
-                        content_type=content_type,
-                        options={'x-goog-meta-owner': owner})
-
-    gcs_file.write(contents)
-    gcs_file.close()
-
-    logging.info('Uploaded file %s as %s in the cloud.', image_name, filename)
+    timestamp = datetime.strftime(datetime.now(), '%Y_%M_%d_%H_%M_%S_%s')
+    uploads = []
+    # Cloud Storage filename -> name of the file as uploaded by the user.
+    filenames = {}
+    failed_files = []
+    for field in fields:
+      field.file.seek(0)
+      content_type = GetImageContentType(
+          field.file.read(IMAGE_SIGNATURE_SIZE))
+      field.file.seek(0)
+      if not content_type:
+        logging.error('Unknown format for "%s", skipping.', field.filename)
+        failed_files.append(field.filename)
+        continue
+
+      image_name = field.filename.split('.')[0]
+      filename = '/%s/%s_%s' % (MAIN_BUCKET, image_name, timestamp)
+      if filename in filenames:
+        filename = '%s_%d' % (filename, len(uploads))
+      filenames[filename] = field.filename
+      logging.info('Uploading file "%s" as %s...', field.filename, filename)
+      uploads.append((field.file, filename, content_type))
+
+    failed_uploads = UploadFilesToGcs(uploads, owner)
+    failed_files.extend(filenames[filename] for filename in failed_uploads)
+    if failed_files:
+      logging.error('%d of %d files not uploaded: %s', len(failed_files),
+                    len(fields), ', '.join(failed_files))
+      # Only unknown formats are the client's fault.
+      self.response.set_status(500 if failed_uploads else 400)
+      self.WriteUploadForm(failed_files)
+      return
 
     self.redirect('/')
 
@@ -187,27 +400,81 @@ class UpdateWithBitifiedPic(webapp2.RequestHandler):
 
     bitdoc_id = self.request.get('id')
 
+    # Fetch the Bitdoc while the image link is looked up.
+    get_rpc = db.get_async(bitdoc_id)
+    status = self.request.get('status') == 'True'
+    image_8bit_name = self.request.get('image_8bit_name')
+    image_8bit_link = None
+    if status and image_8bit_name:
+      image_8bit_link = GetImageLinkFromBucket(BIT_BUCKET, image_8bit_name)
+
     # Update existing Bitdoc with image link and timestamp.
-    bitdoc = db.get(bitdoc_id)
+    bitdoc = get_rpc.get_result()
     if not bitdoc:
       logging.error('No Bitdoc found for id: %s', bitdoc_id)
       self.error(404)
+      return
 
-    status = self.request.get('status') == 'True'
-    image_8bit_name = self.request.get('image_8bit_name')
-    if status and image_8bit_name:
-      bitdoc.image_8bit_link = GetImageLinkFromBucket(BIT_BUCKET,
-                                                      image_8bit_name)
-    else:
-      bitdoc.image_8bit_link = ('http://commondatastorage.googleapis.com/'
-                                '8bit-images%2Fbucket_missing_image.png')
-    bitdoc.timestamp_8bit = datetime.now()
-    bitdoc.put()
+    SetBitifiedImageLink(bitdoc, image_8bit_link)
+    db.put_async([bitdoc, BitdocSummary.FromBitdoc(bitdoc)]).get_result()
+    InvalidateFrontPageListing()
 
     logging.info('Successfully updated Bitdoc %s with link %s',
                  bitdoc_id, bitdoc.image_8bit_link)
 
 
+class BatchUpdateWithBitifiedPics(webapp2.RequestHandler):
+  """Handler for GCE callback with a batch of updated 8-bit image data."""
+
+  def post(self):  # pylint: disable=g-bad-name
+    """GCE batch callback.
+
+    The body is a JSON list of {"id", "status", "image_8bit_name"} records.
+    All Bitdocs are fetched and stored with one batch get and put.
+    """
+    logging.debug('%s', self.request.body)
+
+    try:
+      updates = json.loads(self.request.body)
+    except ValueError, e:
+      logging.error('Invalid batch update body: %s', e)
+      self.error(400)
+      return
+
+    # Fetch the Bitdocs while the image links are looked up.
+    get_rpc = db.get_async([update['id'] for update in updates])
+    image_8bit_links = GetImageLinksFromBucket(
+        BIT_BUCKET,
+        [update['image_8bit_name'] for update in updates
+         if update.get('status') and update.get('image_8bit_name')])
+    bitdocs = get_rpc.get_result()
+
+    updated = []
+    missing = []
+    for update, bitdoc in zip(updates, bitdocs):
+      if not bitdoc:
+        logging.error('No Bitdoc found for id: %s', update['id'])
+        missing.append(update['id'])
+        continue
+      image_8bit_link = None
+      if update.get('status'):
+        image_8bit_link = image_8bit_links.get(update.get('image_8bit_name'))
+      SetBitifiedImageLink(bitdoc, image_8bit_link)
+      updated.append(bitdoc)
+    db.put_async(updated + [BitdocSummary.FromBitdoc(bitdoc)
+                            for bitdoc in updated]).get_result()
+    InvalidateFrontPageListing()
+
+    logging.info('Successfully updated %d Bitdocs, %d not found.',
+                 len(updated), len(missing))
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({
+        'updated': [str(bitdoc.key()) for bitdoc in updated],
+        'missing': missing
+    }))
+
+
 class ObjectChangeNotification(webapp2.RequestHandler):
   """Object Change Notification (OCN) handler for cloud storage upload."""
 
@@ -227,10 +494,20 @@ class ObjectChangeNotification(webapp2.RequestHandler):
       data = json.loads(self.request.body)
       bucket = data['bucket']
       object_name = data['name']
+      generation = int(data.get('generation', 0))
 
-      # Get Image location in GCS.
+      # Get Image location in GCS and start looking up its public URL.
       gcs_image_location = '/gs/%s/%s' % (bucket, object_name)
-      blob_key = blobstore.create_gs_key(gcs_image_location)
+      lookup = serving_urls.GetServingUrlsAsync(
+          [gcs_image_location])[gcs_image_location]
+      # Meanwhile, check whether this notification was already handled.
+      # Notifications are delivered at least once.
+      bitdoc_key = Bitdoc.KeyForObject(bucket, object_name)
+      stored_bitdoc = db.get_async(bitdoc_key).get_result()
+      if not IsNewGeneration(generation, stored_bitdoc):
+        logging.info('Already handled %s generation %d.',
+                     gcs_image_location, generation)
+        return
 
       # Try and get username from metadata.
       if data.has_key('metadata') and data['metadata'].has_key('owner'):
@@ -238,11 +515,17 @@ class ObjectChangeNotification(webapp2.RequestHandler):
       else:
         owner = data['owner']['entity']
 
+      # Bulk uploads are processed in their own lower priority lane.
+      if data.get('metadata', {}).get('priority') == BULK_PRIORITY:
+        queue = bulk_processing_task_queue
+      else:
+        queue = processing_task_queue
+
       # Try to get public image URL for entry creation.
       image_link = None
 
       try:
-        image_link = images.get_serving_url(blob_key, secure_url=True)
+        image_link = lookup.get_result()
       except images.ObjectNotFoundError:
         logging.error('Could not find image link for %s.',
                       gcs_image_location)
@@ -251,9 +534,11 @@ class ObjectChangeNotification(webapp2.RequestHandler):
                       gcs_image_location)
 
       if image_link:
-        bitdoc = Bitdoc(user=owner,
+        bitdoc = Bitdoc(key=bitdoc_key,
+                        user=owner,
                         image_link=image_link,
-                        file_name=object_name)
+                        file_name=object_name,
+                        generation=generation)
 
         logging.info('Creating Entry... %s - %s',
                      bitdoc.user,
@@ -261,14 +546,14 @@ class ObjectChangeNotification(webapp2.RequestHandler):
 
         # timestamp auto.
 
-        bitdoc.put()
-
-        # Add Task to pull queue.
+        # Add Task to pull queue, in the same transaction as the Bitdoc and
+        # the Bitdocs of concurrent notifications.
         info = {'key': unicode(bitdoc.key()),
                 'image_link': unicode(image_link)}
 
-        processing_task_queue.add(taskqueue.Task(payload=json.dumps(info),
-                                                 method='PULL'))
+        if not ocn_batcher.Send((bitdoc, json.dumps(info), queue)):
+          logging.info('Concurrently handled %s generation %d.',
+                       gcs_image_location, generation)
 
 
 class Delete(webapp2.RequestHandler):
@@ -276,9 +561,13 @@ class Delete(webapp2.RequestHandler):
 
   def post(self):  # pylint: disable=g-bad-name
     """Removes the bitdoc with given id."""
-    bitdoc = db.get(self.request.get('id'))
-    if bitdoc:
-      bitdoc.delete()
+    bitdoc_id = self.request.get('id')
+    if bitdoc_id:
+      # Deleting a missing entity is a no-op, so no need to fetch it first.
+      db.delete_async([db.Key(bitdoc_id),
+                       db.Key.from_path('BitdocSummary',
+                                        bitdoc_id)]).get_result()
+      InvalidateFrontPageListing()
     self.redirect('/')
 
 
@@ -287,11 +576,17 @@ class GetEntry(webapp2.RequestHandler):
 
   def get(self, key):  # pylint: disable=g-bad-name
     """Returns single entry in html or json format."""
-    bitdoc = db.get(key)
+    get_rpc = db.get_async(key)
+    mode = self.request.get('mode')
+    if mode != 'json':
+      # Load the template while the Bitdoc is fetched.
+      template = jinja_environment.get_template('single_entry.html')
+
+    bitdoc = get_rpc.get_result()
     if not bitdoc:
       self.error(404)
+      return
 
-    mode = self.request.get('mode')
     if mode == 'json':
       data = {
           'user': bitdoc.user,
@@ -308,7 +603,6 @@ class GetEntry(webapp2.RequestHandler):
       user = users.get_current_user()
       greeting = GetGreeting(user, self.request)
 
-      template = jinja_environment.get_template('single_entry.html')
       template_data = {
           'greeting': greeting,
           'bitdoc': bitdoc
@@ -325,6 +619,7 @@ class GetImage(webapp2.RequestHandler):
     bitdoc = db.get(key)
     if not bitdoc:
       self.error(404)
+      return
 
     mode = self.request.get('mode')
     if mode == 'original':
@@ -333,12 +628,41 @@ class GetImage(webapp2.RequestHandler):
       self.redirect(str(bitdoc.image_8bit_link))
 
 
+class BackfillBitdocSummaries(webapp2.RequestHandler):
+  """Writes BitdocSummaries for Bitdocs created before summaries existed."""
+
+  def get(self):  # pylint: disable=g-bad-name
+    """Starts the backfill."""
+    taskqueue.add(url='/admin/backfill_summaries')
+    self.response.write('Backfill started.')
+
+  def post(self):  # pylint: disable=g-bad-name
+    """Backfills one batch and enqueues the next one."""
+    query = Bitdoc.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    bitdocs = query.fetch(BACKFILL_BATCH_SIZE)
+    db.put([BitdocSummary.FromBitdoc(bitdoc) for bitdoc in bitdocs])
+
+    if len(bitdocs) == BACKFILL_BATCH_SIZE:
+      taskqueue.add(url='/admin/backfill_summaries',
+                    params={'cursor': query.cursor()})
+    else:
+      InvalidateFrontPageListing()
+      logging.info('BitdocSummary backfill complete.')
+
+
 application = webapp2.WSGIApplication([('/', MainPage),
                                        ('/ocn', ObjectChangeNotification),
                                        ('/delete', Delete),
                                        ('/get/image/(.*)', GetImage),
                                        ('/get/(.*)', GetEntry),
                                        ('/update', UpdateWithBitifiedPic),
-                                       ('/upload', UploadPage)
+                                       ('/update/batch',
+                                        BatchUpdateWithBitifiedPics),
+                                       ('/upload', UploadPage),
+                                       ('/admin/backfill_summaries',
+                                        BackfillBitdocSummaries)
                                       ],
                                       debug=True)
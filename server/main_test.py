@@ -0,0 +1,175 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the OCN handling in main.py.
+
+Run from this directory with the App Engine SDK and the cloudstorage client
+on the Python path, e.g. python -m unittest discover -p '*_test.py'. The
+datastore, memcache and task queues are the SDK's in-memory stubs.
+"""
+
+import json
+import os
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import main
+from models import Bitdoc
+from models import BitdocSummary
+import serving_urls
+
+BUCKET = 'uploads'
+
+
+class OcnTestCase(unittest.TestCase):
+  """Sets up the datastore, memcache and task queue stubs."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(main.__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(
+        testbed.TASKQUEUE_SERVICE_NAME)
+
+    serving_urls.cached_urls.clear()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Item(self, object_name, generation, queue=None):
+    """Returns the (Bitdoc, task payload, queue) item for a notification."""
+    bitdoc = Bitdoc(key=Bitdoc.KeyForObject(BUCKET, object_name),
+                    user='owner',
+                    image_link='https://images/%s' % object_name,
+                    file_name=object_name,
+                    generation=generation)
+    payload = json.dumps({'key': unicode(bitdoc.key()),
+                          'image_link': bitdoc.image_link})
+    return bitdoc, payload, queue or main.processing_task_queue
+
+  def EnqueuedLinks(self, queue_name=main.TASKQUEUE):
+    """Returns the sorted image links of the tasks in a queue."""
+    tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=[queue_name])
+    return sorted(json.loads(task.payload)['image_link'] for task in tasks)
+
+  def StoredGeneration(self, object_name):
+    """Returns the generation of the object's stored Bitdoc, or None."""
+    bitdoc = Bitdoc.get(Bitdoc.KeyForObject(BUCKET, object_name))
+    return bitdoc and bitdoc.generation
+
+
+class CreateBitdocsWithTasksTest(OcnTestCase):
+
+  def testDuplicateInBatchWrittenOnce(self):
+    written = main.CreateBitdocsWithTasks([self.Item('a', 1),
+                                           self.Item('b', 1),
+                                           self.Item('a', 1)])
+
+    self.assertEqual([True, True, False], written)
+    self.assertEqual(['https://images/a', 'https://images/b'],
+                     self.EnqueuedLinks())
+    self.assertEqual(2, BitdocSummary.all().count())
+
+  def testDuplicateAcrossBatchesSkipped(self):
+    self.assertEqual([True], main.CreateBitdocsWithTasks([self.Item('a', 1)]))
+    self.assertEqual([False, True],
+                     main.CreateBitdocsWithTasks([self.Item('a', 1),
+                                                  self.Item('b', 1)]))
+
+    self.assertEqual(['https://images/a', 'https://images/b'],
+                     self.EnqueuedLinks())
+
+  def testReuploadProcessedAgain(self):
+    main.CreateBitdocsWithTasks([self.Item('a', 1)])
+
+    self.assertEqual([True], main.CreateBitdocsWithTasks([self.Item('a', 2)]))
+    self.assertEqual(2, self.StoredGeneration('a'))
+    self.assertEqual(['https://images/a', 'https://images/a'],
+                     self.EnqueuedLinks())
+
+  def testStaleGenerationIgnored(self):
+    main.CreateBitdocsWithTasks([self.Item('a', 2)])
+
+    self.assertEqual([False], main.CreateBitdocsWithTasks([self.Item('a', 1)]))
+    self.assertEqual(2, self.StoredGeneration('a'))
+    self.assertEqual(['https://images/a'], self.EnqueuedLinks())
+
+  def testBulkItemsGoToBulkQueue(self):
+    main.CreateBitdocsWithTasks([
+        self.Item('a', 1),
+        self.Item('b', 1, queue=main.bulk_processing_task_queue)])
+
+    self.assertEqual(['https://images/a'], self.EnqueuedLinks())
+    self.assertEqual(['https://images/b'],
+                     self.EnqueuedLinks(main.BULK_TASKQUEUE))
+
+  def testRetriedTransactionAddsFreshTasks(self):
+    # A duplicate notification for the same object commits first, so the
+    # batch's first transaction attempt collides and is retried.
+    queue = main.processing_task_queue
+    add = queue.add
+    concurrent_bitdocs = [self.Item('a', 1)[0]]
+    def AddAfterConcurrentWrite(tasks, transactional=False):
+      if concurrent_bitdocs:
+        db.run_in_transaction_options(
+            db.create_transaction_options(propagation=db.INDEPENDENT),
+            concurrent_bitdocs.pop().put)
+      return add(tasks, transactional=transactional)
+    queue.add = AddAfterConcurrentWrite
+    self.addCleanup(delattr, queue, 'add')
+
+    written = main.CreateBitdocsWithTasks([self.Item('a', 1),
+                                           self.Item('b', 1)])
+
+    self.assertEqual([False, True], written)
+    self.assertEqual(['https://images/b'], self.EnqueuedLinks())
+    self.assertIsNotNone(Bitdoc.get(Bitdoc.KeyForObject(BUCKET, 'b')))
+
+
+class ObjectChangeNotificationTest(OcnTestCase):
+
+  def Notify(self, object_name, generation):
+    """Posts an 'exists' notification for an uploaded object."""
+    gcs_location = '/gs/%s/%s' % (BUCKET, object_name)
+    serving_urls.CacheUrl(gcs_location, 'https://images/%s' % object_name)
+    body = json.dumps({'bucket': BUCKET,
+                       'name': object_name,
+                       'generation': str(generation),
+                       'owner': {'entity': 'user-owner'}})
+    response = main.application.get_response(
+        '/ocn', method='POST', body=body,
+        headers={'X-Goog-Resource-State': 'exists'})
+    self.assertEqual(200, response.status_int)
+
+  def testReplayedStreamProcessesEachGenerationOnce(self):
+    # Notifications are delivered at least once and not in order.
+    for object_name, generation in [('a', 1), ('b', 1), ('a', 1),
+                                    ('a', 2), ('b', 1), ('a', 1)]:
+      self.Notify(object_name, generation)
+
+    self.assertEqual(['https://images/a', 'https://images/a',
+                      'https://images/b'], self.EnqueuedLinks())
+    self.assertEqual(2, self.StoredGeneration('a'))
+    self.assertEqual(1, self.StoredGeneration('b'))
+    self.assertEqual(2, Bitdoc.all().count())
+    self.assertEqual(2, BitdocSummary.all().count())
+
+
+if __name__ == '__main__':
+  unittest.main()
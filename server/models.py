@@ -30,6 +30,17 @@ class Bitdoc(db.Model):
   file_name = db.StringProperty()
   image_8bit_link = db.StringProperty()
   timestamp_8bit = db.DateTimeProperty()
+  # Generation of the Cloud Storage object the Bitdoc was created from.
+  generation = db.IntegerProperty(indexed=False)
+
+  @classmethod
+  def KeyForObject(cls, bucket, object_name):
+    """Returns the key of the Bitdoc for a Cloud Storage object.
+
+    Notifications for an object always map to the same Bitdoc, so repeated
+    deliveries cannot create duplicates.
+    """
+    return db.Key.from_path(cls.kind(), '%s/%s' % (bucket, object_name))
 
   @property
   def timestamp_strsafe(self):
@@ -49,3 +60,33 @@ class Bitdoc(db.Model):
     if self.file_name:
       return cgi.escape(self.file_name)
     return None
+
+
+class BitdocSummary(db.Model):
+  """Compact copy of the Bitdoc fields shown in list views.
+
+  Keyed by the string form of its Bitdoc's key, with timestamps formatted
+  when written, so list views need neither full Bitdoc loads nor per-item
+  formatting. Must be written whenever the Bitdoc changes.
+  """
+  user = db.StringProperty(indexed=False)
+  timestamp = db.DateTimeProperty()
+  timestamp_strsafe = db.StringProperty(indexed=False)
+  image_link = db.StringProperty(indexed=False)
+  image_8bit_link = db.StringProperty(indexed=False)
+  timestamp_8bit_strsafe = db.StringProperty(indexed=False)
+
+  @classmethod
+  def FromBitdoc(cls, bitdoc):
+    """Returns the summary for a saved Bitdoc."""
+    return cls(key_name=str(bitdoc.key()),
+               user=bitdoc.user,
+               timestamp=bitdoc.timestamp,
+               timestamp_strsafe=bitdoc.timestamp_strsafe,
+               image_link=bitdoc.image_link,
+               image_8bit_link=bitdoc.image_8bit_link,
+               timestamp_8bit_strsafe=bitdoc.timestamp_8bit_strsafe)
+
+  @property
+  def bitdoc_key(self):
+    return self.key().name()
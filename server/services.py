@@ -22,9 +22,10 @@ from protorpc import messages
 from protorpc import remote
 import yaml
 
-from models import Bitdoc
+from models import BitdocSummary
 
 from google.appengine.api import app_identity
+from google.appengine.ext import db
 from google.appengine.ext import endpoints
 
 # Load config options from settings.cfg
@@ -43,11 +44,19 @@ AUDIENCE = config['ENDPOINTS']['AUDIENCE']
 GCS_API_URL = 'https://%s.commondatastorage.googleapis.com'
 GCS_BUCKET = config['GCS']['MAIN_BUCKET']
 
+# Largest number of images returned by a single ListImages call.
+MAX_LIST_IMAGES_LIMIT = 100
+
 
 class ListImagesRequest(messages.Message):
-  """List images message request."""
+  """List images message request.
+
+  page_token is the next_page_token of a previous response. offset is only
+  used when no page_token is given.
+  """
   limit = messages.IntegerField(1, default=10)
   offset = messages.IntegerField(2, default=0)
+  page_token = messages.StringField(3)
 
 
 class ListImage(messages.Message):
@@ -63,6 +72,7 @@ class ListImage(messages.Message):
 class ListImagesResponse(messages.Message):
   """Multiple image message response."""
   images = messages.MessageField(ListImage, 1, repeated=True)
+  next_page_token = messages.StringField(2)
 
 
 class StorageSignedUrlRequest(messages.Message):
@@ -102,9 +112,24 @@ class ImageApi(remote.Service):
     """Returns list of images to the client."""
     GetEndpointsAuthUser()
 
+    limit = max(1, min(request.limit, MAX_LIST_IMAGES_LIMIT))
+    query = BitdocSummary.all().order('-timestamp')
+    try:
+      if request.page_token:
+        query.with_cursor(request.page_token)
+        items = query.fetch(limit=limit)
+      else:
+        # Offsets are still supported for older clients.
+        items = query.fetch(limit=limit, offset=request.offset)
+    except (db.BadValueError, db.BadRequestError):
+      raise endpoints.BadRequestException('Invalid page_token.')
+
+    next_page_token = None
+    if len(items) == limit:
+      next_page_token = query.cursor()
+
     images = []
-    query = Bitdoc.all().order('-timestamp')
-    for item in query.fetch(limit=request.limit, offset=request.offset):
+    for item in items:
       images.append(
           ListImage(
               user=item.user,
@@ -112,10 +137,10 @@ class ImageApi(remote.Service):
               image_link=item.image_link,
               image_8bit_link=item.image_8bit_link,
               timestamp_8bit=item.timestamp_8bit_strsafe,
-              key=str(item.key())
+              key=item.bitdoc_key
           )
       )
-    return ListImagesResponse(images=images)
+    return ListImagesResponse(images=images, next_page_token=next_page_token)
 
   @endpoints.method(StorageSignedUrlRequest, StorageSignedUrlResponse,
                     path='GenerateStorageSignedUrl',
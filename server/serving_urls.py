@@ -0,0 +1,148 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of image serving URLs for Cloud Storage objects."""
+
+from collections import OrderedDict
+import threading
+from time import time
+
+from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.ext import blobstore
+
+# Serving URLs cached per instance, and seconds a URL stays cached. A serving
+# URL does not change once created, so the TTL only bounds staleness after
+# an object was deleted and re-uploaded under the same name.
+MAX_CACHED_URLS = 1000
+URL_CACHE_TIME_SEC = 24 * 60 * 60
+# Seconds an ObjectNotFoundError is cached. Kept short as notifications can
+# arrive before a freshly written object is visible to the images service.
+NOT_FOUND_CACHE_TIME_SEC = 30
+MEMCACHE_PREFIX = 'serving_url:'
+
+# Cached value standing for ObjectNotFoundError.
+NOT_FOUND = ''
+
+# GCS path -> (serving URL or NOT_FOUND, expiry time), least recent first.
+cached_urls = OrderedDict()
+cached_urls_lock = threading.Lock()
+
+
+def GetCachedUrl(gcs_location):
+  """Returns the locally cached value for gcs_location, or None."""
+  with cached_urls_lock:
+    entry = cached_urls.pop(gcs_location, None)
+    if entry is None or entry[1] < time():
+      return None
+    # Re-insert as most recently used.
+    cached_urls[gcs_location] = entry
+    return entry[0]
+
+
+def CacheTime(value):
+  """Returns the seconds a lookup result stays cached."""
+  if value == NOT_FOUND:
+    return NOT_FOUND_CACHE_TIME_SEC
+  return URL_CACHE_TIME_SEC
+
+
+def SetCachedUrl(gcs_location, value):
+  """Caches a lookup result for gcs_location locally."""
+  cache_time_sec = CacheTime(value)
+  with cached_urls_lock:
+    cached_urls.pop(gcs_location, None)
+    cached_urls[gcs_location] = (value, time() + cache_time_sec)
+    while len(cached_urls) > MAX_CACHED_URLS:
+      cached_urls.popitem(last=False)
+
+
+def CacheUrl(gcs_location, value):
+  """Caches a lookup result locally and in memcache."""
+  SetCachedUrl(gcs_location, value)
+  # Not waited on; App Engine completes the RPC before the request ends.
+  memcache.Client().set_multi_async({gcs_location: value},
+                                    time=CacheTime(value),
+                                    key_prefix=MEMCACHE_PREFIX)
+
+
+class ServingUrlLookup(object):
+  """Result of a serving URL lookup, from the cache or an in-flight RPC.
+
+  get_result() returns the serving URL or raises the same errors as
+  images.get_serving_url.
+  """
+
+  def __init__(self, gcs_location, value=None, blob_key_rpc=None):
+    self.gcs_location = gcs_location
+    self.value = value
+    self.blob_key_rpc = blob_key_rpc
+    self.url_rpc = None
+
+  def StartUrlRpc(self):
+    """Starts the serving URL RPC once the blob key is available."""
+    if self.blob_key_rpc and not self.url_rpc:
+      self.url_rpc = images.get_serving_url_async(
+          self.blob_key_rpc.get_result(), secure_url=True)
+
+  def get_result(self):  # pylint: disable=g-bad-name
+    if self.value is None:
+      self.StartUrlRpc()
+      try:
+        self.value = self.url_rpc.get_result()
+      except images.ObjectNotFoundError:
+        self.value = NOT_FOUND
+      CacheUrl(self.gcs_location, self.value)
+    if self.value == NOT_FOUND:
+      raise images.ObjectNotFoundError()
+    return self.value
+
+
+def GetServingUrlsAsync(gcs_locations):
+  """Starts serving URL lookups for '/gs/bucket/object' paths.
+
+  Returns a dict from each path to its ServingUrlLookup. Paths not cached
+  locally or in memcache have their RPCs issued together, so the lookups
+  run in parallel.
+  """
+  lookups = {}
+  for gcs_location in gcs_locations:
+    value = GetCachedUrl(gcs_location)
+    if value is not None:
+      lookups[gcs_location] = ServingUrlLookup(gcs_location, value=value)
+
+  missing = [gcs_location for gcs_location in set(gcs_locations)
+             if gcs_location not in lookups]
+  if missing:
+    values = memcache.get_multi(missing, key_prefix=MEMCACHE_PREFIX)
+    for gcs_location, value in values.iteritems():
+      SetCachedUrl(gcs_location, value)
+      lookups[gcs_location] = ServingUrlLookup(gcs_location, value=value)
+
+  pending = []
+  for gcs_location in missing:
+    if gcs_location not in lookups:
+      lookup = ServingUrlLookup(
+          gcs_location,
+          blob_key_rpc=blobstore.create_gs_key_async(gcs_location))
+      lookups[gcs_location] = lookup
+      pending.append(lookup)
+  # All blob key RPCs are in flight; chain the serving URL RPCs onto them.
+  for lookup in pending:
+    try:
+      lookup.StartUrlRpc()
+    except Exception:  # pylint: disable=broad-except
+      # Raised again from the lookup's get_result().
+      pass
+  return lookups